@@ -1,30 +1,175 @@
+import asyncio
+import atexit
 import base64
-import requests
+import re
+import threading
+import time
 
-from typing import Dict, Union
-from flask import Flask, request, jsonify, render_template_string
-import httpx
-import base64
+from concurrent.futures import Future
+from typing import AsyncIterable, Dict, Iterable, Optional, Tuple, Union
 import requests
+from flask import Flask, Response, request, jsonify
 
 from config import config
 from utiles.logger import Logger
-from memory_agent import MemoryAgent
-from providers.dalle import Dalle
+from memory_agent import (AgentRegistry, MemoryAgent, SUPPORTED_MEDIA_TYPES, as_batch, get_letta_client, list_agents,
+                          passage_stats)
+from providers import chat
+from providers.dalle import Dalle, cache_stats as dalle_cache_stats, get_client as dalle_client
+from utiles.worker_pool import KeyedWorkerPool, QueueFullError
+from utiles import http_client, metrics
+from utiles.cache import TTLCache
+from utiles.cache_backend import get_backend
+from utiles.image_prep import prepare_image
+from utiles.media_cache import MediaCache
+from utiles.reply_stream import SentenceChunker
+from utiles.idempotency import create_store, message_key
+from utiles.send_scheduler import BULK, INTERACTIVE, SendScheduler
+from utiles.debounce import Debouncer
+from utiles.circuit_breaker import CircuitOpenError, breaker_stats, get_breaker
+from utiles.sharding import FORWARDED_HEADER, create_router
+from utiles.journal import JournalDrainer, get_journal
 
 
 logger = Logger()
 app = Flask(__name__)
 
+# "queued" acknowledges webhooks with 202 and processes them on the worker pool,
+# "inline" keeps the old behaviour of processing inside the request
+WEBHOOK_MODE = config.get("webhook_mode", "queued").lower()
+
+DEFAULT_SESSION = "default"
+# comma separated WAHA sessions to serve; empty accepts webhooks from any session
+WAHA_SESSIONS = [name.strip() for name in config.get("waha_sessions", "").split(",") if name.strip()]
+# without WAHA_SESSIONS, at most this many sessions are created from webhooks and pairing
+MAX_SESSIONS = config.get("max_sessions", 10, int)
+# "off" sends the agent reply once complete, "chunks" sends it sentence by sentence as it
+# is generated and "edit" sends the first sentences and then edits that message as text arrives
+REPLY_STREAMING = config.get("reply_streaming", "off").lower()
+REPLY_MIN_INTERVAL = config.get("reply_min_interval", 1.0, float)
+REPLY_CHUNK_MIN_CHARS = config.get("reply_chunk_min_chars", 40, int)
+# seconds to wait for more messages from a chat before asking the agent, 0 answers every message on its own
+CHAT_DEBOUNCE = config.get("chat_debounce", 0, float)
+CHAT_DEBOUNCE_MAX_WAIT = config.get("chat_debounce_max_wait", 10, float)
+# sent when neither the memory agent nor the stateless fallback can answer
+BUSY_TEXT = config.get("busy_text", "Sorry, I can't answer right now. Please try again in a few minutes.")
+_media_cache_dir = config.get("media_cache_dir", ".media_cache")
+_media_cache = MediaCache(directory=None if _media_cache_dir.lower() == "none" else _media_cache_dir,
+                          max_memory_bytes=config.get("media_cache_memory_bytes", 64 * 1024 * 1024, int),
+                          max_disk_bytes=config.get("media_cache_disk_bytes", 512 * 1024 * 1024, int))
+# message ids already handled, so WAHA retries and echoes don't reach the agent twice
+_dedup = create_store(config.get("webhook_dedup", "memory"),
+                      path=config.get("webhook_dedup_path", ".dedup.sqlite3"),
+                      max_size=config.get("webhook_dedup_window", 10000, int),
+                      ttl=config.get("webhook_dedup_ttl", 86400, float))
+# with several worker processes (SHARD_PEERS), each chat is handled by the one its hash maps to
+_router = create_router()
+
+
+class Session:
+    """Everything tied to one WAHA session (WhatsApp number).
+
+    Each session has its own contact and group caches, memory agents and
+    worker pool with its own backlog limit, so a noisy number can't starve
+    the others. The caches are shared with the other worker processes when
+    CACHE_BACKEND is.
+    """
+    agent_factory = MemoryAgent
+
+    def __init__(self, name: str):
+        self.name = name
+        self.agents = AgentRegistry(max_size=config.get("agent_registry_size", 1000, int),
+                                    idle_ttl=config.get("agent_idle_ttl", 3600, float),
+                                    factory=self._create_agent, session=name)
+        self.contacts = TTLCache(maxsize=config.get("contact_cache_size", 5000, int),
+                                 ttl=config.get("contact_cache_ttl", 3600, float), name=f"{name}-contacts",
+                                 backend=get_backend())
+        self.groups = TTLCache(maxsize=config.get("group_cache_size", 500, int),
+                               ttl=config.get("group_cache_ttl", 600, float), name=f"{name}-groups",
+                               backend=get_backend())
+        self.pool = KeyedWorkerPool(workers=config.get("webhook_workers", 8, int),
+                                    max_pending=config.get("webhook_max_pending", 1000, int),
+                                    name=f"{name}-worker")
+
+    def _create_agent(self, recipient: str, **kwargs) -> MemoryAgent:
+        # looked up on use, so the ASGI app can switch the class after sessions exist
+        return self.agent_factory(recipient, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "queue": self.pool.stats(),
+            "agents": self.agents.stats(),
+            "cache": {"contacts": self.contacts.stats(), "groups": self.groups.stats()},
+        }
+
+
+_sessions: Dict[str, Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(name: str = DEFAULT_SESSION) -> Session:
+    session = _sessions.get(name)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(name)
+            if session is None:
+                session = _sessions[name] = Session(name)
+    return session
+
+
+def is_served(name: str) -> bool:
+    # session names end up in WAHA URL paths and agent names
+    if not isinstance(name, str) or not re.fullmatch(r"[\w-]+", name):
+        return False
+    if WAHA_SESSIONS:
+        return name in WAHA_SESSIONS
+    # each session holds a worker pool, so unlisted ones are capped
+    return name in _sessions or len(_sessions) < MAX_SESSIONS
 
-_memory_agents = {}
-_contacts = {}
+
+def stop_sessions():
+    for session in list(_sessions.values()):
+        session.pool.stop()
+
+
+
+def warm_up_clients():
+    """Import the SDKs and create the shared Letta, OpenAI and WAHA clients before the first message needs them."""
+    started = time.monotonic()
+    for name, create in (("Letta", get_letta_client), ("OpenAI", dalle_client), ("WAHA", http_client.get_session)):
+        try:
+            create()
+        except Exception as e:
+            logger.error(f"Creating the {name} client failed: {e}")
+    logger.info(f"Clients ready in {time.monotonic() - started:.2f}s")
+
+
+def warm_up_agents():
+    try:
+        # one listing of the memory server seeds the registries of all configured sessions
+        agents = list_agents()
+        for name in WAHA_SESSIONS or [DEFAULT_SESSION]:
+            get_session(name).agents.warm_up(agents)
+    except Exception as e:
+        logger.error(f"Memory agent warm-up failed: {e}")
+
+
+def warm_up():
+    # off the import path, so the server answers /health while the SDKs load
+    if config.get("client_warm_up", True, bool):
+        warm_up_clients()
+    if config.get("agent_warm_up", True, bool):
+        warm_up_agents()
+
+
+threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
 
 
 class Group:
-    def __init__(self, group_id):
+    def __init__(self, group_id, data: Optional[Dict] = None, session: str = DEFAULT_SESSION):
         self.group_id = group_id
-        self.data = self.get_group(group_id)
+        self.session = session
+        self.data = data if data is not None else self.get_group(group_id)
         self.name = self.data.get("name", "")
         self.participants = self.data.get("participants", [])
         self.is_group = True
@@ -32,20 +177,22 @@ class Group:
         self.isMe = True if self.data.get("isMe", False) else False
 
     def get_group(self, id):
-        endpoint = f"/api/session/groups/{id}"
-        response = send_request(method="GET", endpoint=endpoint)
-        logger.debug(f"Retrieved group info for {id}: {response.json()}")
-        return response.json()
+        endpoint = f"/api/{self.session}/groups/{id}"
+        data = send_request(method="GET", endpoint=endpoint).json()
+        logger.debug("Retrieved group info for %s: %s", id, data)
+        return data
 
     def __str__(self):
         return f"Group ID: {self.group_id}, Name: {self.name}, Participants: {len(self.participants)}"
 
 
 class Contact:
-    def __init__(self, payload):
+    def __init__(self, payload, data: Optional[Dict] = None, session: str = DEFAULT_SESSION):
+        self.session = session
         self._from = payload.get("from", "")
         self.participant = payload.get("participant", "")
-        data = self.get_contact()
+        if data is None:
+            data = self.get_contact()
 
         self.isMyContact = data.get("isMyContact", False)
         if self.isMyContact:
@@ -64,75 +211,329 @@ class Contact:
     def get_contact(self):
         endpoint = f"/api/contacts"
         contact = self.participant if self.participant and self.participant != "out@c.us" else self._from
-        params = {"contactId": contact, "session": "default"}
+        params = {"contactId": contact, "session": self.session}
         response = send_request(method="GET", endpoint=endpoint, params=params)
         return response.json()
 
+    @staticmethod
+    def contact_id(payload: Dict) -> str:
+        participant = payload.get("participant", "")
+        return participant if participant and participant != "out@c.us" else payload.get("from", "")
+
     def __str__(self):
         return self.__dict__.__str__()
 
 
-def get_contact(payload):
+def payload_contact(payload, session: str = DEFAULT_SESSION) -> "Contact":
+    """Contact built from the push name in the payload, for when WAHA can't be asked; never cached."""
+    return Contact(payload, data={"pushname": payload.get("_data", {}).get("notifyName", "")}, session=session)
+
+
+def get_contact(payload, session: str = DEFAULT_SESSION):
+    sender = Contact.contact_id(payload)
     try:
-        sender = payload["participant"]
-    except KeyError:
-        sender = payload.get("from", None)
+        with metrics.stage("contact_lookup"):
+            contact = get_session(session).contacts.get_or_load(sender, lambda: Contact(payload, session=session))
+    except Exception as e:
+        logger.warning(f"Contact lookup for {sender} failed, using the push name: {e}")
+        return payload_contact(payload, session)
+    logger.debug("Retrieved contact for sender %s: %s", sender, contact)
+    return contact
 
-    if sender not in _contacts:
-        _contacts[sender] = Contact(payload)
-    logger.debug(f"Retrieved contact for sender {sender}: {_contacts[sender]}")
-    return _contacts[sender]
 
+def get_group(group_id: str, session: str = DEFAULT_SESSION) -> Group:
+    try:
+        with metrics.stage("group_lookup"):
+            return get_session(session).groups.get_or_load(group_id, lambda: Group(group_id, session=session))
+    except Exception as e:
+        logger.warning(f"Group lookup for {group_id} failed: {e}")
+        return Group(group_id, data={}, session=session)
 
-def get_memory_agent(recipient: str) -> MemoryAgent:
-    if recipient not in _memory_agents:
-        _memory_agents[recipient] = MemoryAgent(recipient)
-    return _memory_agents[recipient]
 
+async def async_get_contact(payload, session: str = DEFAULT_SESSION) -> Contact:
+    sender = Contact.contact_id(payload)
 
-def send_request(method: str, endpoint: str, payload: Union[Dict, None] = None, params: Union[Dict, None] = None):
-    payload = payload or {}
-    params = params or {}
+    async def load():
+        params = {"contactId": sender, "session": session}
+        response = await async_send_request(method="GET", endpoint="/api/contacts", params=params)
+        return Contact(payload, data=response.json(), session=session)
 
-    headers = {"X-Api-Key": config.waha_api_key}
-    url = f"{config.waha_api_url}{endpoint}"
+    try:
+        with metrics.stage("contact_lookup"):
+            return await get_session(session).contacts.async_get_or_load(sender, load)
+    except Exception as e:
+        logger.warning(f"Contact lookup for {sender} failed, using the push name: {e}")
+        return payload_contact(payload, session)
 
-    method_map = {
-        "GET": requests.get,
-        "POST": requests.post,
-        "PUT": requests.put,
-    }
 
-    func = method_map[method.upper()]
+async def async_get_group(group_id: str, session: str = DEFAULT_SESSION) -> Group:
+    async def load():
+        response = await async_send_request(method="GET", endpoint=f"/api/{session}/groups/{group_id}")
+        return Group(group_id, data=response.json(), session=session)
+
+    try:
+        with metrics.stage("group_lookup"):
+            return await get_session(session).groups.async_get_or_load(group_id, load)
+    except Exception as e:
+        logger.warning(f"Group lookup for {group_id} failed: {e}")
+        return Group(group_id, data={}, session=session)
 
-    kwargs = {
-        "headers": headers,
-        "stream": True,
-    }
+
+def invalidate_cache(event: str, payload: Dict, session: str = DEFAULT_SESSION):
+    """Drop cached groups/contacts touched by a WAHA group.* or contact.* event."""
+    state = get_session(session)
+    if event.startswith("group."):
+        group = payload.get("group") or payload
+        group_id = group.get("id") if isinstance(group, dict) else None
+        if isinstance(group_id, dict):
+            group_id = group_id.get("_serialized")
+        if group_id:
+            state.groups.invalidate(group_id)
+        for participant in payload.get("participants", []) or []:
+            participant_id = participant.get("id") if isinstance(participant, dict) else participant
+            if participant_id:
+                state.contacts.invalidate(participant_id)
+        logger.debug("Invalidated cache for %s on group %s", event, group_id)
+    elif event.startswith("contact."):
+        contact_id = payload.get("id") or payload.get("contactId")
+        if contact_id:
+            state.contacts.invalidate(contact_id)
+        logger.debug("Invalidated cache for %s on contact %s", event, contact_id)
+
+
+def get_memory_agent(recipient: str, session: str = DEFAULT_SESSION) -> MemoryAgent:
+    return get_session(session).agents.get(recipient)
+
+
+def try_memory_agent(recipient: str, session: str = DEFAULT_SESSION) -> Optional[MemoryAgent]:
+    """The chat's memory agent, or None while the memory server can't provide it."""
+    try:
+        return get_memory_agent(recipient, session)
+    except Exception as e:
+        logger.warning(f"No memory agent for {recipient}: {e}")
+        return None
+
+
+_waha = get_breaker("waha")
+
+
+def waha_operation(method: str, endpoint: str) -> str:
+    # chat, group and file ids would make a metric series per chat
+    return f"{method.upper()} {re.sub(r'/[^/]*[0-9@.][^/]*', '/:id', endpoint)}"
+
+
+def waha_request(method: str, endpoint: str, payload: Union[Dict, None] = None,
+                 params: Union[Dict, None] = None) -> Tuple[str, Dict]:
+    """URL and keyword arguments of a WAHA call, the same for the sync and async clients."""
+    payload = payload or {}
+    params = params or {}
+
+    url = f"{config.waha_api_url}{endpoint}"
+    kwargs = {}
 
     if method.upper() == "GET":
         # fallback to payload if params not given
         kwargs["params"] = params or payload
     else:
         kwargs["json"] = payload
+    return url, kwargs
+
 
-    response = func(url, **kwargs)
-    response.raise_for_status()
+def send_request(method: str, endpoint: str, payload: Union[Dict, None] = None, params: Union[Dict, None] = None):
+    url, kwargs = waha_request(method, endpoint, payload, params)
+    with _waha.guard(), metrics.downstream("waha", waha_operation(method, endpoint)):
+        response = http_client.request(method, url, **kwargs)
+        response.raise_for_status()
     # logger.debug(f"Request to {url} completed with status code {response.status_code}")
     return response
 
 
+async def async_send_request(method: str, endpoint: str, payload: Union[Dict, None] = None,
+                             params: Union[Dict, None] = None):
+    url, kwargs = waha_request(method, endpoint, payload, params)
+    with _waha.guard(), metrics.downstream("waha", waha_operation(method, endpoint)):
+        response = await http_client.async_request(method, url, **kwargs)
+        response.raise_for_status()
+    return response
+
+
+# messages and images the scheduler could not deliver; edits and typing indicators are not worth keeping
+JOURNALED_ENDPOINTS = ("/api/sendText", "/api/sendImage")
+
+
+def journal_send(session: str, chat_id: str, method: str, endpoint: str, payload: Dict) -> bool:
+    journal = get_journal()
+    if journal is None or method != "POST" or endpoint not in JOURNALED_ENDPOINTS:
+        return False
+    journal.append("send", {"session": session, "chat_id": chat_id, "endpoint": endpoint, "payload": payload})
+    logger.warning(f"Journaled message to {chat_id} until WAHA is back")
+    return True
+
+
+# messages to WhatsApp go through the scheduler so bursts are paced per chat and per session
+_outbound = SendScheduler(sender=send_request,
+                          chat_rate=config.get("outbound_chat_rate", 1.0, float),
+                          chat_burst=config.get("outbound_chat_burst", 3, float),
+                          session_rate=config.get("outbound_session_rate", 10.0, float),
+                          session_burst=config.get("outbound_session_burst", 20, float),
+                          workers=config.get("outbound_workers", 4, int),
+                          max_retries=config.get("outbound_retries", 3, int),
+                          coalesce_window=config.get("outbound_coalesce_window", 2.0, float),
+                          observe_wait=lambda seconds: metrics.STAGE_SECONDS.observe(seconds, "outbound_wait"),
+                          spill=journal_send)
+# image generation takes tens of seconds, so it runs on its own small pool and never holds up chat replies
+DALLE_PENDING_TEXT = config.get("dalle_pending_text", "Generating image…")
+DALLE_FAILED_TEXT = "Sorry, the image could not be generated."
+_image_jobs = KeyedWorkerPool(workers=config.get("dalle_workers", 2, int),
+                              max_pending=config.get("dalle_max_pending", 100, int),
+                              name="dalle-worker")
+# atexit runs handlers in reverse: the worker pools drain, then queued sends go out, then the HTTP session closes
+atexit.register(http_client.close_session)
+atexit.register(_outbound.stop)
+atexit.register(_image_jobs.stop)
+atexit.register(stop_sessions)
+
+
+def replay_send(entry: Dict):
+    # paced like any other send, behind live replies; a failure stays in the journal rather than being journaled again
+    _outbound.send(entry["session"], entry["chat_id"], entry["endpoint"], entry["payload"],
+                   priority=BULK, durable=False).result()
+
+
+def replay_passages(entry: Dict):
+    get_session(entry["session"]).agents.get(entry["recipient"])._write_passages(entry["lines"])
+
+
+# replays what WAHA or the memory server could not take, also after a restart
+_journal_drainer = None
+if get_journal() is not None:
+    _journal_drainer = JournalDrainer(get_journal(), batch_size=config.get("journal_batch_size", 50, int),
+                                      max_backoff=config.get("journal_max_backoff", 60.0, float))
+    # a send that may have reached WAHA (a read timeout, a dropped connection) is not sent twice
+    _journal_drainer.register("send", replay_send, retryable=lambda e: http_client.retryable("POST", e))
+    _journal_drainer.register("passage", replay_passages)
+    _journal_drainer.start()
+    # runs first at exit, so no replay is started while the pools and the scheduler shut down
+    atexit.register(_journal_drainer.stop)
+
+
+def get_image_jobs() -> KeyedWorkerPool:
+    _image_jobs.start()
+    return _image_jobs
+
+
+def send_image(session: str, chat_id: str, image_url: str) -> Future:
+    return queue_send(session, chat_id,
+                      endpoint="/api/sendImage",
+                      payload={
+                          "chatId": chat_id,
+                          "file": {"url": image_url},
+                          "session": session
+                      })
+
+
+def send_text(session: str, chat_id: str, text: str) -> Future:
+    return queue_send(session, chat_id, "/api/sendText", {"chatId": chat_id, "text": text, "session": session})
+
+
+def generate_image(dalle: Dalle, session: str, chat_id: str):
+    try:
+        with metrics.stage("image_generation"):
+            image_url = dalle.request()
+    except Exception as e:
+        logger.error(f"Image generation for {chat_id} failed: {e}")
+        send_text(session, chat_id, DALLE_FAILED_TEXT)
+        return
+    send_image(session, chat_id, image_url).result()
+
+
+def queue_send(session: str, chat_id: str, endpoint: str, payload: Dict, priority: int = INTERACTIVE,
+               method: str = "POST") -> Future:
+    return _outbound.send(session, chat_id, endpoint, payload, priority=priority, method=method)
+
+
+async def async_queue_send(session: str, chat_id: str, endpoint: str, payload: Dict, priority: int = INTERACTIVE,
+                           method: str = "POST"):
+    return await asyncio.wrap_future(queue_send(session, chat_id, endpoint, payload, priority, method))
+
+
+def cached_media(mimetype: str, cache_key: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """(done, base64): done when the media is not downloaded, being unsupported or already cached."""
+    if mimetype not in SUPPORTED_MEDIA_TYPES:
+        logger.debug("Skipping download of unsupported media type %s", mimetype)
+        return True, None
+    cached = _media_cache.get(cache_key) if cache_key else None
+    return cached is not None, cached
+
+
+def media_download_failed(url: str, e: Exception):
+    if isinstance(e, (http_client.DownloadTooLargeError, CircuitOpenError)):
+        # the message goes to the agent as text only
+        logger.warning(f"Skipping media download: {e}")
+    else:
+        logger.error(f"Error downloading media from {url}: {e}")
+
+
+def fetch_media(url: str, mimetype: str, cache_key: Optional[str] = None) -> Optional[str]:
+    """Download media and return it base64 encoded, or None if it is unsupported or unavailable."""
+    done, cached = cached_media(mimetype, cache_key)
+    if done:
+        return cached
+    try:
+        with _waha.guard(), metrics.stage("media_download"):
+            data = http_client.download(url)
+    except Exception as e:
+        media_download_failed(url, e)
+        return None
+    with metrics.stage("media_prepare"):
+        return _media_cache.put(cache_key or url, data, prepare=lambda raw: prepare_image(raw, mimetype))
+
+
+async def async_fetch_media(url: str, mimetype: str, cache_key: Optional[str] = None) -> Optional[str]:
+    done, cached = cached_media(mimetype, cache_key)
+    if done:
+        return cached
+    try:
+        with _waha.guard(), metrics.stage("media_download"):
+            data = await http_client.async_download(url)
+    except Exception as e:
+        media_download_failed(url, e)
+        return None
+    with metrics.stage("media_prepare"):
+        # resizing is CPU work that would stall every other conversation on the loop
+        return await asyncio.to_thread(_media_cache.put, cache_key or url, data,
+                                       lambda raw: prepare_image(raw, mimetype))
+
+
 class MediaMessage:
-    def __init__(self, data):
+    def __init__(self, data, message_id: str = ""):
         # logger.debug(f"Message has media: {payload}")
+        self.message_id = message_id
         self.url = data.get('url')
         self.type = data.get('mimetype')
-        self.base64 = base64.standard_b64encode(httpx.get(
-            self.url, headers={"X-Api-Key": config.waha_api_key}).content).decode("utf-8")
+        self.cache_key = message_id or self.url
+        self._base64 = None
+        self._fetched = False
+
+    @property
+    def base64(self) -> Optional[str]:
+        # downloaded on first access so messages that are never sent to the agent cost nothing
+        if not self._fetched:
+            self._fetched = True
+            if self.url:
+                self._base64 = fetch_media(self.url, self.type, cache_key=self.cache_key)
+        return self._base64
+
+    async def aload(self) -> Optional[str]:
+        if not self._fetched:
+            self._fetched = True
+            if self.url:
+                self._base64 = await async_fetch_media(self.url, self.type, cache_key=self.cache_key)
+        return self._base64
 
 
 class QuotedMessage:
-    def __init__(self, quoted_data, recipient):
+    def __init__(self, quoted_data, recipient, session: str = DEFAULT_SESSION):
         self.quoted_data = quoted_data
         self.quoted_msg = quoted_data.get("quotedMsg", {})
         self.type = self.quoted_msg.get("type", "")
@@ -142,38 +543,181 @@ class QuotedMessage:
         self.quoted_participant = quoted_data.get("quotedParticipant", "")
         self.mimetype = self.quoted_msg.get("mimetype", "")
         self.caption = self.quoted_msg.get("caption", "").strip()
+        self._base64_data = None
+        self._fetched = False
         if self.type == "image":
             self.file_extension = self.mimetype.split("/")[-1]
             self.filename = f"true_{recipient}_{self.quoted_stanza_id}_{self.quoted_participant}.{self.file_extension}"
-            endpoint = f"/api/files/default/{self.filename}"
-            response = send_request(method="GET", endpoint=endpoint)
-            self.base64_data = base64.b64encode(
-                response.content).decode("ascii")
+            self.url = f"{config.waha_api_url}/api/files/{session}/{self.filename}"
+            self.cache_key = self.quoted_stanza_id or self.filename
+
+    @property
+    def base64_data(self) -> Optional[str]:
+        if not self._fetched:
+            self._fetched = True
+            if self.type == "image":
+                self._base64_data = fetch_media(self.url, self.mimetype, cache_key=self.cache_key)
+        return self._base64_data
+
+    async def aload(self) -> Optional[str]:
+        if not self._fetched:
+            self._fetched = True
+            if self.type == "image":
+                self._base64_data = await async_fetch_media(self.url, self.mimetype, cache_key=self.cache_key)
+        return self._base64_data
+
+
+def sent_message_id(response) -> Optional[str]:
+    """Id of the message created by a WAHA send call; its shape differs between engines."""
+    if response is None:
+        # journaled, to be sent once WAHA is back
+        return None
+    try:
+        data = response.json()
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    message_id = data.get("id") or data.get("key", {}).get("id")
+    if isinstance(message_id, dict):
+        message_id = message_id.get("_serialized")
+    return message_id
+
+
+class StreamedReply:
+    """Delivers an agent reply to a chat while it is still being generated.
+
+    A typing indicator goes out first, then sentence-sized chunks at most one
+    per ``REPLY_MIN_INTERVAL`` seconds. In "edit" mode only the first chunk
+    is sent as a message and later ones edit it; if an edit fails the rest
+    is sent as separate messages. Chunks are queued on the outbound
+    scheduler without waiting, so ones held back by its rate limits merge.
+    """
+
+    def __init__(self, chat_id: str, mode: str = REPLY_STREAMING, session: str = DEFAULT_SESSION):
+        self.chat_id = chat_id
+        self.mode = mode
+        self.session = session
+        self.message_id: Optional[str] = None
+        self.queued = []
+        self.chunker = SentenceChunker(min_chars=REPLY_CHUNK_MIN_CHARS, min_interval=REPLY_MIN_INTERVAL)
+
+    def _typing_request(self, active: bool):
+        endpoint = "/api/startTyping" if active else "/api/stopTyping"
+        return "POST", endpoint, {"chatId": self.chat_id, "session": self.session}
+
+    def _edit_request(self):
+        endpoint = f"/api/{self.session}/chats/{self.chat_id}/messages/{self.message_id}"
+        return self.session, self.chat_id, endpoint, {"text": self.chunker.released}
+
+    def _send_request(self, chunk: str):
+        return self.session, self.chat_id, "/api/sendText", {"chatId": self.chat_id, "text": chunk,
+                                                             "session": self.session}
+
+    def _sent(self, response):
+        if self.mode == "edit" and self.message_id is None:
+            self.message_id = sent_message_id(response)
+
+    def _edit_failed(self, e: Exception):
+        logger.warning(f"Editing streamed reply in {self.chat_id} failed, sending the rest as new messages: {e}")
+        self.mode = "chunks"
+
+    def _send(self, chunk: Optional[str]):
+        if not chunk:
+            return
+        if self.mode == "edit" and self.message_id:
+            try:
+                queue_send(*self._edit_request(), method="PUT").result()
+                return
+            except Exception as e:
+                self._edit_failed(e)
+        future = queue_send(*self._send_request(chunk))
+        if self.mode == "edit":
+            # the message id is needed for the edits that follow
+            self._sent(future.result())
+        else:
+            self.queued.append(future)
+
+    def _typing(self, active: bool):
+        try:
+            send_request(*self._typing_request(active))
+        except Exception as e:
+            logger.debug("Typing indicator for %s failed: %s", self.chat_id, e)
+
+    def deliver(self, deltas: Iterable[str]) -> str:
+        self._typing(True)
+        try:
+            for delta in deltas:
+                self._send(self.chunker.feed(delta))
+            time.sleep(self.chunker.wait_time())
+            self._send(self.chunker.finish())
+            for future in self.queued:
+                future.result()
+        finally:
+            self._typing(False)
+        return self.chunker.text
+
+    async def _asend(self, chunk: Optional[str]):
+        if not chunk:
+            return
+        if self.mode == "edit" and self.message_id:
+            try:
+                await async_queue_send(*self._edit_request(), method="PUT")
+                return
+            except Exception as e:
+                self._edit_failed(e)
+        future = queue_send(*self._send_request(chunk))
+        if self.mode == "edit":
+            self._sent(await asyncio.wrap_future(future))
+        else:
+            self.queued.append(future)
+
+    async def _atyping(self, active: bool):
+        try:
+            await async_send_request(*self._typing_request(active))
+        except Exception as e:
+            logger.debug("Typing indicator for %s failed: %s", self.chat_id, e)
+
+    async def adeliver(self, deltas: AsyncIterable[str]) -> str:
+        await self._atyping(True)
+        try:
+            async for delta in deltas:
+                await self._asend(self.chunker.feed(delta))
+            await asyncio.sleep(self.chunker.wait_time())
+            await self._asend(self.chunker.finish())
+            for future in self.queued:
+                await asyncio.wrap_future(future)
+        finally:
+            await self._atyping(False)
+        return self.chunker.text
 
 
 class WhatsappMSG:
-    def __init__(self, payload):
+    def __init__(self, payload, contact: Optional[Contact] = None, group: Optional[Group] = None,
+                 session: str = DEFAULT_SESSION):
         # logger.debug(f"Initializing WhatsappMSG with payload: {payload}")
+        self.session = session
         self.message = payload.get("body", "").strip()
-        self.contact = get_contact(payload=payload)
+        self.contact = contact or get_contact(payload=payload, session=session)
         self.recipient = payload.get("to", "")
         self._from = payload.get("from", "")
         self.is_group = True if "@g" in self._from else False
         if self.is_group:
-            self.group = Group(self._from)
+            self.group = group or get_group(self._from, session=session)
         self.has_media = payload.get("hasMedia", False)
         if self.has_media:
-            self.media = MediaMessage(payload.get("media"))
+            self.media = MediaMessage(payload.get("media") or {}, message_id=payload.get("id", ""))
         self.has_quote = payload.get("_data", {}).get("quotedMsg", {})
         if self.has_quote:
             try:
                 self.quoted = QuotedMessage(quoted_data=payload.get(
-                    "_data", {}), recipient=self.recipient)
+                    "_data", {}), recipient=self.recipient, session=session)
             except Exception as e:
                 logger.error(f"Error processing quoted message: {e}")
                 self.quoted = None
         else:
             self.quoted = None
+        self.streamed: Optional[StreamedReply] = None
 
     def is_valid(self) -> bool:
         allowed_senders = []
@@ -195,14 +739,51 @@ class WhatsappMSG:
             return "unknown"
 
     def reply(self, response: str):
-        send_request(method="POST",
-                     endpoint="/api/sendText",
-                     payload={
-                              "chatId": self.recipient,
-                              "text": response,
-                              "session": "default"
-                     }
-                     )
+        with metrics.stage("reply_send"):
+            queue_send(self.session, self.recipient,
+                       endpoint="/api/sendText",
+                       payload={
+                                "chatId": self.recipient,
+                                "text": response,
+                                "session": self.session
+                       }
+                       ).result()
+
+    def stream_reply(self, deltas: Iterable[str]) -> str:
+        self.streamed = StreamedReply(self.recipient, session=self.session)
+        return self.streamed.deliver(deltas)
+
+    @classmethod
+    async def from_payload(cls, payload, session: str = DEFAULT_SESSION) -> "WhatsappMSG":
+        """Async constructor: resolves contact and group without blocking the event loop."""
+        contact = await async_get_contact(payload, session=session)
+        _from = payload.get("from", "")
+        group = await async_get_group(_from, session=session) if "@g" in _from else None
+        return cls(payload, contact=contact, group=group, session=session)
+
+    async def load_media(self):
+        if self.has_media:
+            await self.media.aload()
+        if self.quoted:
+            await self.quoted.aload()
+
+    async def areply(self, response: str):
+        with metrics.stage("reply_send"):
+            await async_queue_send(self.session, self.recipient,
+                                   endpoint="/api/sendText",
+                                   payload={
+                                       "chatId": self.recipient,
+                                       "text": response,
+                                       "session": self.session
+                                   })
+
+    async def astream_reply(self, deltas: AsyncIterable[str]) -> str:
+        self.streamed = StreamedReply(self.recipient, session=self.session)
+        return await self.streamed.adeliver(deltas)
+
+    def stream_started(self) -> bool:
+        """Whether part of a streamed reply was already produced, so a fallback would repeat it."""
+        return self.streamed is not None and bool(self.streamed.chunker.text.strip())
 
     def __str__(self):
         return f"From: {self.contact.name}, To: {self.recipient}, Message: '{self.message}'"
@@ -210,95 +791,449 @@ class WhatsappMSG:
 
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "up"}), 200
+    return jsonify({
+        "status": "up",
+        "sessions": {name: session.stats() for name, session in list(_sessions.items())},
+        "passages": passage_stats(),
+        "cache": {"media": _media_cache.stats(), "shared": get_backend().stats()},
+        "dedup": _dedup.stats() if _dedup else None,
+        "outbound": _outbound.stats(),
+        "images": {"queue": _image_jobs.stats(), "cache": dalle_cache_stats()},
+        "debounce": _debouncer.stats(),
+        "circuits": breaker_stats(),
+        "shard": _router.stats() if _router else None,
+        "journal": _journal_drainer.stats() if _journal_drainer else None,
+    }), 200
 
 
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    payload = request.json.get("payload", {}) if request.json else {}
-    whatsapp_msg = WhatsappMSG(payload)
-    mem_agent: MemoryAgent = get_memory_agent(whatsapp_msg._from)
-    mem_agent.remember(text=whatsapp_msg.message,
-                       role=whatsapp_msg.contact.name or "unknown")
+def prefilter(payload: Dict) -> str:
+    """Decide from the raw payload alone, without any network call, what a message needs.
+
+    "drop" for messages with no text and status broadcasts, "process" for
+    messages carrying a bot prefix and "remember" for all other chatter.
+    """
+    body = (payload.get("body") or "").strip()
+    if not body or payload.get("from") == "status@broadcast":
+        return "drop"
+    if body.startswith(config.chat_prefix) or body.startswith(config.dalle_prefix):
+        return "process"
+    return "remember"
+
+
+def sender_name(payload: Dict, session: str = DEFAULT_SESSION) -> str:
+    """Sender name for remembered chatter: the cached contact if there is one, else the push name sent along."""
+    if payload.get("fromMe"):
+        # the owner's push name would make them a second person next to their prefixed messages
+        return "Me"
+    contact = get_session(session).contacts.peek(Contact.contact_id(payload))
+    if contact is not None:
+        return contact.name or "unknown"
+    return payload.get("_data", {}).get("notifyName") or "unknown"
+
+
+def remember_message(payload: Dict, session: str = DEFAULT_SESSION) -> str:
+    with metrics.stage("remember"):
+        get_session(session).agents.remember(payload.get("from", ""), payload.get("body", "").strip(),
+                                             sender_name(payload, session))
+    return "remembered"
+
+
+def handle_message(payload, action: str = "process", session: str = DEFAULT_SESSION):
+    with metrics.stage(f"message_{action}"):
+        return process_message(payload, action, session)
+
+
+def process_message(payload, action: str = "process", session: str = DEFAULT_SESSION):
+    if action == "remember":
+        return remember_message(payload, session)
+
+    whatsapp_msg = WhatsappMSG(payload, session=session)
+    mem_agent = try_memory_agent(whatsapp_msg._from, session)
+    with metrics.stage("remember"):
+        get_session(session).agents.remember(whatsapp_msg._from, whatsapp_msg.message,
+                                             whatsapp_msg.contact.name or "unknown")
 
     if not whatsapp_msg.is_valid():
-        return jsonify({"status": "ignored"}), 200
+        return "ignored"
+
+    route = whatsapp_msg.route()
+    if route == "chat":
+        if CHAT_DEBOUNCE > 0:
+            _debouncer.add(debounce_key(session, whatsapp_msg), whatsapp_msg)
+            return "debounced"
+        answer_chat(mem_agent, whatsapp_msg)
+    elif route == "dalle":
+        dalle = Dalle()
+        dalle.context = recent_context(mem_agent)
 
+        dalle.prompt = whatsapp_msg.message[len(
+            config.dalle_prefix):].strip()
+        image_url = dalle.cached()
+        if image_url:
+            send_image(session, whatsapp_msg.recipient, image_url).result()
+            return "ok"
+        # queued before the job starts, so it always arrives ahead of the image
+        whatsapp_msg.reply(DALLE_PENDING_TEXT)
+        try:
+            get_image_jobs().submit(whatsapp_msg.recipient, generate_image, dalle, session, whatsapp_msg.recipient)
+        except QueueFullError as e:
+            logger.warning(f"Rejecting image request: {e}")
+            whatsapp_msg.reply(DALLE_FAILED_TEXT)
+            return "busy"
+        return "generating"
+    else:
+        logger.debug("Message did not match any route: %s", whatsapp_msg.message)
+        return "no matching handler"
+    return "ok"
+
+
+def recent_context(mem_agent: Optional[MemoryAgent]) -> str:
     try:
-        route = whatsapp_msg.route()
-        if route == "chat":
-            response = mem_agent.send_message(whatsapp_msg)
-            whatsapp_msg.reply(str(response))
-        elif route == "dalle":
-            dalle = Dalle()
-            dalle.context = mem_agent.get_recent_text_context()
+        return mem_agent.get_recent_text_context() if mem_agent is not None else ""
+    except Exception as e:
+        logger.warning(f"No recent context for {mem_agent.chat_id}: {e}")
+        return ""
 
-            dalle.prompt = whatsapp_msg.message[len(
-                config.dalle_prefix):].strip()
-            image_url = dalle.request()
 
-            send_request(method="POST",
-                         endpoint="/api/sendImage",
-                         payload={
-                             "chatId": payload.get("to"),
-                             "file": {"url": image_url},
-                             "session": "default"
-                         })
+def fallback_input(mem_agent: Optional[MemoryAgent], whatsapp_msg) -> Tuple[list, str]:
+    """The texts to answer and the rolling context they are answered on, without the memory server."""
+    context = mem_agent.context.text() if mem_agent is not None and mem_agent.context.loaded else ""
+    return [msg.message for msg in as_batch(whatsapp_msg)], context
 
-        else:
-            logger.debug(
-                f"Message did not match any route: {whatsapp_msg.message}")
-            return jsonify({"status": "no matching handler"}), 200
-        return jsonify({"status": "ok"}), 200
 
+def fallback_reply(mem_agent: Optional[MemoryAgent], whatsapp_msg) -> str:
+    """Answer without the memory server: a stateless LLM call on the rolling context, else BUSY_TEXT."""
+    texts, context = fallback_input(mem_agent, whatsapp_msg)
+    if chat.enabled():
+        try:
+            with metrics.stage("fallback_call"):
+                response = chat.reply(texts, context)
+            if mem_agent is not None:
+                mem_agent._record_exchange(whatsapp_msg, response)
+            return response
+        except Exception as e:
+            logger.error(f"Fallback answer failed: {e}")
+    return BUSY_TEXT
+
+
+def answer_chat(mem_agent: Optional[MemoryAgent], whatsapp_msg):
+    """One agent call and one reply, for a single message or a debounced burst of them."""
+    last = as_batch(whatsapp_msg)[-1]
+    if mem_agent is None:
+        last.reply(fallback_reply(None, whatsapp_msg))
+        return
+    try:
+        if REPLY_STREAMING != "off":
+            # generating and sending overlap, so a streamed reply is timed as one stage
+            with metrics.stage("agent_stream"):
+                if last.stream_reply(mem_agent.stream_message(whatsapp_msg)).strip():
+                    return
+            # like a response without an assistant message, nothing was sent yet
+            raise ValueError("the agent streamed no reply text")
+        with metrics.stage("agent_call"):
+            response = mem_agent.send_message(whatsapp_msg)
     except Exception as e:
+        if last.stream_started():
+            raise
+        logger.warning(f"Memory agent could not answer {last._from}, answering without it: {e}")
+        response = fallback_reply(mem_agent, whatsapp_msg)
+    last.reply(str(response))
+
+
+def debounce_key(session: str, whatsapp_msg) -> tuple:
+    # the owner writes to many chats, and a burst must only hold messages its reply goes back to
+    return session, whatsapp_msg._from, whatsapp_msg.recipient
+
+
+def answer_batch(key, whatsapp_msgs):
+    session, chat_id, _ = key
+    try:
+        answer_chat(try_memory_agent(chat_id, session), whatsapp_msgs)
+    finally:
+        _debouncer.done(key)
+
+
+def release_batch(key, whatsapp_msgs):
+    # back on the sender's worker queue, so the batch stays in order with their other messages
+    session, chat_id, _ = key
+    get_worker_pool(session).submit(chat_id, answer_batch, key, whatsapp_msgs)
+
+
+_debouncer = Debouncer(window=CHAT_DEBOUNCE, max_wait=CHAT_DEBOUNCE_MAX_WAIT, on_ready=release_batch,
+                       name="chat-debounce")
+# registered after the pools' handler, so waiting bursts are handed over before the pools drain
+atexit.register(_debouncer.stop)
+
+
+def metric_families(queues: Dict[str, dict]):
+    """Queue, cache and buffer figures for /metrics, read from the stats the components already keep.
+
+    ``queues`` maps a queue name to its stats, as the Flask and ASGI apps
+    run messages on different pools.
+    """
+    sessions = list(_sessions.items())
+    caches = [({"cache": kind, "session": name}, cache.stats())
+              for name, session in sessions for kind, cache in (("contacts", session.contacts),
+                                                                ("groups", session.groups))]
+    caches.append(({"cache": "dalle", "session": ""}, dalle_cache_stats()))
+    media = _media_cache.stats()
+    passages = passage_stats()
+    outbound = _outbound.stats()
+    families = [
+        ("whatsapp_queue_depth", "gauge", "Messages waiting in a worker queue.",
+         [({"queue": name}, stats["depth"]) for name, stats in queues.items()]),
+        ("whatsapp_queue_active", "gauge", "Messages being handled by a worker queue.",
+         [({"queue": name}, stats["active"]) for name, stats in queues.items()]),
+        ("whatsapp_queue_failed_total", "counter", "Messages whose handler raised.",
+         [({"queue": name}, stats["failed"]) for name, stats in queues.items()]),
+        ("whatsapp_queue_rejected_total", "counter", "Messages rejected because a queue was full.",
+         [({"queue": name}, stats["rejected"]) for name, stats in queues.items()]),
+        ("whatsapp_cache_hits_total", "counter", "Cache lookups answered from the cache.",
+         [(labels, stats["hits"]) for labels, stats in caches] + [({"cache": "media", "session": ""}, media["hits"])]),
+        ("whatsapp_cache_misses_total", "counter", "Cache lookups that had to load the value.",
+         [(labels, stats["misses"]) for labels, stats in caches]
+         + [({"cache": "media", "session": ""}, media["misses"])]),
+        ("whatsapp_cache_entries", "gauge", "Entries held by a cache.",
+         [(labels, stats["size"]) for labels, stats in caches] + [({"cache": "media", "session": ""}, media["keys"])]),
+        ("whatsapp_agents", "gauge", "Memory agents loaded.",
+         [({"session": name}, session.agents.stats()["agents"]) for name, session in sessions]),
+        ("whatsapp_passages_pending", "gauge", "Passages buffered for the memory server.",
+         [({}, passages["pending"])]),
+        ("whatsapp_passages_written_total", "counter", "Passages written to the memory server.",
+         [({}, passages["written"])]),
+        ("whatsapp_passages_failed_total", "counter", "Passage writes that failed.",
+         [({}, passages["failed"])]),
+        ("whatsapp_outbound_depth", "gauge", "Sends waiting for their rate limit.", [({}, outbound["depth"])]),
+        ("whatsapp_outbound_sends_total", "counter", "Outbound sends by result.",
+         [({"result": result}, outbound[result]) for result in ("sent", "failed", "retried", "coalesced", "rejected")]),
+        ("whatsapp_debounce_pending", "gauge", "Messages waiting for their chat to go quiet.",
+         [({}, _debouncer.stats()["pending"])]),
+        ("whatsapp_media_bytes_total", "counter", "Size of downloaded images, as received and as sent to the agent.",
+         [({"form": "received"}, media["received_bytes"]), ({"form": "prepared"}, media["prepared_bytes"])]),
+    ]
+    circuits = breaker_stats()
+    families.append(("whatsapp_circuit_open", "gauge", "1 while calls to a dependency are being refused.",
+                     [({"service": name}, int(stats["state"] == "open")) for name, stats in circuits.items()]))
+    families.append(("whatsapp_circuit_rejected_total", "counter", "Calls refused by an open circuit.",
+                     [({"service": name}, stats["rejected"]) for name, stats in circuits.items()]))
+    if _journal_drainer:
+        journal = _journal_drainer.stats()
+        families.append(("whatsapp_journal_pending", "gauge", "Sends and passages waiting in the journal for replay.",
+                         [({}, journal["pending"])]))
+        families.append(("whatsapp_journal_entries_total", "counter", "Journal entries by outcome.",
+                         [({"result": result}, journal[result]) for result in ("appended", "replayed", "skipped")]))
+    if _router:
+        shard = _router.stats()
+        families.append(("whatsapp_shard_forwards_total", "counter",
+                         "Webhooks passed on to the worker owning the chat.",
+                         [({"result": "forwarded"}, shard["forwarded"]), ({"result": "failed"}, shard["failed"])]))
+    if _dedup:
+        dedup = _dedup.stats()
+        families.append(("whatsapp_dedup_total", "counter", "Webhook message ids checked for duplicates.",
+                         [({"result": "claimed"}, dedup["claimed"]), ({"result": "duplicate"}, dedup["duplicates"])]))
+    return families
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    queues = {name: session.pool.stats() for name, session in list(_sessions.items())}
+    queues["images"] = _image_jobs.stats()
+    return Response(metrics.render(metric_families(queues)), content_type=metrics.CONTENT_TYPE)
+
+
+def webhook_status(status: str) -> Dict:
+    """Response body of a webhook, counting its outcome for /metrics."""
+    metrics.WEBHOOKS.inc(status)
+    return {"status": status}
+
+
+def shard_owner(payload: Dict, session: str = DEFAULT_SESSION) -> Optional[int]:
+    """Worker that owns the message's chat, None if it is this one (or there is only one)."""
+    if _router is None:
+        return None
+    owner = _router.owner(f"{session}:{payload.get('from', '')}")
+    return None if owner == _router.index else owner
+
+
+# (body, status code, headers) of a webhook response, turned into a Flask or Quart response by each app
+Answer = Tuple[Dict, int, Dict]
+
+
+def webhook_answer(status: str, code: int = 200, headers: Optional[Dict] = None) -> Answer:
+    return webhook_status(status), code, headers or {}
+
+
+class Admission:
+    """What the checks every webhook goes through decided, in the Flask and the ASGI app alike.
+
+    ``answer`` is set when the webhook is settled without handling it, and
+    ``owner`` when another worker owns the chat and the body is forwarded
+    to it. ``broadcast`` asks to pass the body on to every other worker as
+    well, for events that concern all of them. Otherwise the message is handled; ``key`` is its claimed dedup
+    key, released again when it can't be.
+    """
+
+    def __init__(self, payload: Optional[Dict] = None, session: str = DEFAULT_SESSION, action: str = "",
+                 key: Optional[str] = None, owner: Optional[int] = None, answer: Optional[Answer] = None,
+                 broadcast: bool = False):
+        self.payload = payload
+        self.session = session
+        self.action = action
+        self.key = key
+        self.owner = owner
+        self.answer = answer
+        self.broadcast = broadcast
+
+    @property
+    def sender(self) -> str:
+        return self.payload.get("from", "")
+
+    def _release(self):
+        if self.key:
+            # let the retry WAHA sends after Retry-After through
+            _dedup.release(self.key)
+
+    def rejected(self, e: QueueFullError) -> Answer:
+        logger.warning(f"Rejecting webhook: {e}")
+        self._release()
+        return webhook_answer("busy", 503, {"Retry-After": "5"})
+
+    def deferred(self, e: CircuitOpenError) -> Answer:
+        logger.warning(f"Deferring webhook: {e}")
+        self._release()
+        return webhook_answer("unavailable", 503, {"Retry-After": str(max(1, round(e.retry_in)))})
+
+    def failed(self, e: Exception):
         logger.error(f"Failed to process message: {e}")
+        metrics.WEBHOOKS.inc("error")
+        self._release()
+
+
+def admit_webhook(body: Optional[Dict], forwarded: bool = False) -> Admission:
+    """Session, event, prefilter, shard and duplicate checks of a webhook, before any I/O of the app."""
+    payload = body.get("payload", {}) if body else {}
+    if not payload:
+        return Admission(answer=webhook_answer("ignored"))
+
+    session = body.get("session") or DEFAULT_SESSION
+    if not is_served(session):
+        logger.warning(f"Ignoring webhook for unknown session {session}")
+        return Admission(answer=webhook_answer("ignored"))
+
+    event = body.get("event", "")
+    if event.startswith(("group.", "contact.")):
+        invalidate_cache(event, payload, session)
+        # every worker holds its own copy of the contact and group caches
+        return Admission(answer=webhook_answer("invalidated"), broadcast=_router is not None and not forwarded)
+
+    action = prefilter(payload)
+    if action == "drop":
+        return Admission(answer=webhook_answer("ignored"))
+
+    # the owner claims the message id and queues it behind the chat's earlier messages
+    owner = shard_owner(payload, session) if not forwarded else None
+    if owner is not None:
+        return Admission(payload, session, action, owner=owner)
+
+    key = message_key(payload, session) if _dedup else None
+    if key and not _dedup.claim(key):
+        logger.debug("Skipping duplicate webhook for message %s", key)
+        return Admission(answer=webhook_answer("duplicate"))
+    return Admission(payload, session, action, key=key)
+
+
+def forward_failed(owner: int, e: Exception) -> Answer:
+    logger.warning(f"Worker {owner} unreachable, deferring webhook: {e}")
+    return webhook_answer("unavailable", 503, {"Retry-After": "5"})
+
+
+def get_worker_pool(session: str = DEFAULT_SESSION) -> KeyedWorkerPool:
+    pool = get_session(session).pool
+    pool.start()
+    return pool
+
+
+def respond(answer: Answer):
+    body, code, headers = answer
+    return jsonify(body), code, headers
+
+
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    admission = admit_webhook(request.get_json(silent=True), forwarded=FORWARDED_HEADER in request.headers)
+    if admission.broadcast:
+        threading.Thread(target=_router.broadcast, args=(request.get_data(),), name="broadcast", daemon=True).start()
+    if admission.answer:
+        return respond(admission.answer)
+
+    if admission.owner is not None:
+        try:
+            status, body, headers = _router.forward(admission.owner, request.get_data())
+        except requests.RequestException as e:
+            return respond(forward_failed(admission.owner, e))
+        metrics.WEBHOOKS.inc("forwarded")
+        return Response(body, status=status, headers=headers)
+
+    if WEBHOOK_MODE == "queued":
+        try:
+            get_worker_pool(admission.session).submit(admission.sender, handle_message, admission.payload,
+                                                      admission.action, admission.session)
+        except QueueFullError as e:
+            return respond(admission.rejected(e))
+        return respond(webhook_answer("queued", 202))
+
+    try:
+        return respond(webhook_answer(handle_message(admission.payload, admission.action, admission.session)))
+    except CircuitOpenError as e:
+        return respond(admission.deferred(e))
+    except Exception as e:
+        admission.failed(e)
         raise
-        return jsonify({"error": str(e)}), 400
 
 
-@app.route("/pair", methods=["GET"])
-def pair():
-    session_name = "default"
+def is_connected(status_data: Dict) -> bool:
+    return status_data.get("status") == "WORKING" and status_data.get("engine", {}).get("state") == "CONNECTED"
 
-    response = send_request("GET", f"/api/sessions/{session_name}")
-    # print(f"Response: {response.json()}")
-    # logger.debug(f"Session status response: {response}")
 
-    status_data = response.json()
-    logger.debug(f"Status data: {status_data}")
+def session_config() -> Dict:
+    """WAHA session config pointing the session's events at this bot."""
+    return {
+        "config": {
+            "webhooks": [
+                {
+                    "url": config.webhook_url,
+                    "events": ["message.any", "session.status",
+                               "group.v2.join", "group.v2.leave",
+                               "group.v2.update", "group.v2.participants"]
+                }
+            ]
+        }
+    }
 
-    if status_data.get("status") == "WORKING" and status_data.get("engine", {}).get("state") == "CONNECTED":
-        return "<h1>Session 'default' is already connected.</h1>", 200
 
-    if status_data.get("status") != "SCAN_QR_CODE":
-        send_request(method="POST", endpoint="/api/sessions/start",
-                     payload={"name": session_name})
-
-        # Step 3: Configure webhook
-        send_request("PUT", f"/api/sessions/{session_name}", {
-            "config": {
-                "webhooks": [
-                    {
-                        "url": config.webhook_url,
-                        "events": ["message.any", "session.status"]
-                    }
-                ]
-            }
-        })
-
-    # Step 4: Get QR code
-    qr_response = send_request("GET", f"/api/{session_name}/auth/qr")
-    if isinstance(qr_response, dict) and "error" in qr_response:
-        return f"Failed to get QR code: {qr_response['error']}", 500
-
-    qr_image_data = qr_response.content
+def qr_page(qr_image_data: bytes) -> Tuple[str, int]:
     if qr_image_data:
         qr_base64 = base64.b64encode(qr_image_data).decode("utf-8")
-        html = f"<h1>Scan to Pair WhatsApp</h1><img src='data:image/png;base64,{qr_base64}'>"
-        return render_template_string(html)
-    else:
-        return "QR code not available yet. Please refresh in a few seconds.", 200
+        return f"<h1>Scan to Pair WhatsApp</h1><img src='data:image/png;base64,{qr_base64}'>", 200
+    return "QR code not available yet. Please refresh in a few seconds.", 200
+
+
+@app.route("/pair", methods=["GET"])
+def pair():
+    session_name = request.args.get("session", DEFAULT_SESSION)
+    if not is_served(session_name):
+        return "Unknown session.", 400
+
+    status_data = send_request("GET", f"/api/sessions/{session_name}").json()
+    logger.debug(f"Status data: {status_data}")
+    if is_connected(status_data):
+        return f"<h1>Session '{session_name}' is already connected.</h1>", 200
+
+    if status_data.get("status") != "SCAN_QR_CODE":
+        send_request(method="POST", endpoint="/api/sessions/start", payload={"name": session_name})
+        send_request("PUT", f"/api/sessions/{session_name}", session_config())
+
+    return qr_page(send_request("GET", f"/api/{session_name}/auth/qr").content)
 
 
 if __name__ == "__main__":
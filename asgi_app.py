@@ -0,0 +1,307 @@
+import asyncio
+from typing import Dict, Optional
+
+import httpx
+from quart import Quart, Response, request, jsonify
+
+from config import config
+import app as wsgi
+from app import DEFAULT_SESSION, WhatsappMSG, admit_webhook, async_send_request, get_session, metric_families, \
+    remember_message, send_image, send_text
+from memory_agent import AsyncMemoryAgent, PASSAGE_WRITE_BEHIND, as_batch, close_async_letta_client, passage_stats
+from providers import chat
+from providers.dalle import AsyncDalle, cache_stats as dalle_cache_stats
+from utiles import http_client, metrics
+from utiles.logger import Logger
+from utiles.debounce import Debouncer
+from utiles.cache_backend import get_backend
+from utiles.circuit_breaker import CircuitOpenError, breaker_stats
+from utiles.sharding import FORWARDED_HEADER
+from utiles.worker_pool import AsyncKeyedRunner, QueueFullError
+
+
+logger = Logger()
+app = Quart(__name__)
+
+WEBHOOK_MODE = wsgi.WEBHOOK_MODE
+
+# the ASGI process shares the sessions (caches, agent registries) of app.py, but its agents talk to Letta asynchronously
+wsgi.Session.agent_factory = AsyncMemoryAgent
+_dedup = wsgi._dedup
+# one runner per session, like the worker pools of app.py
+_runners: Dict[str, AsyncKeyedRunner] = {}
+
+
+def get_runner(session: str) -> AsyncKeyedRunner:
+    runner = _runners.get(session)
+    if runner is None:
+        runner = _runners[session] = AsyncKeyedRunner(concurrency=config.get("async_concurrency", 256, int),
+                                                      max_pending=config.get("webhook_max_pending", 1000, int),
+                                                      name=f"{session}-async-webhook")
+    return runner
+
+
+# image jobs get their own runner so a few slow generations never hold up chat replies
+_image_jobs = AsyncKeyedRunner(concurrency=config.get("dalle_workers", 2, int),
+                               max_pending=config.get("dalle_max_pending", 100, int),
+                               name="async-dalle")
+
+
+async def generate_image(dalle: AsyncDalle, session: str, chat_id: str):
+    try:
+        with metrics.stage("image_generation"):
+            image_url = await dalle.request()
+    except Exception as e:
+        logger.error(f"Image generation for {chat_id} failed: {e}")
+        await asyncio.wrap_future(send_text(session, chat_id, wsgi.DALLE_FAILED_TEXT))
+        return
+    await asyncio.wrap_future(send_image(session, chat_id, image_url))
+
+
+async def recent_context(mem_agent: Optional[AsyncMemoryAgent]) -> str:
+    try:
+        return await mem_agent.get_recent_text_context() if mem_agent is not None else ""
+    except Exception as e:
+        logger.warning(f"No recent context for {mem_agent.chat_id}: {e}")
+        return ""
+
+
+async def fallback_reply(mem_agent: Optional[AsyncMemoryAgent], whatsapp_msg) -> str:
+    texts, context = wsgi.fallback_input(mem_agent, whatsapp_msg)
+    if chat.enabled():
+        try:
+            with metrics.stage("fallback_call"):
+                response = await chat.areply(texts, context)
+            if mem_agent is not None:
+                mem_agent._record_exchange(whatsapp_msg, response)
+            return response
+        except Exception as e:
+            logger.error(f"Fallback answer failed: {e}")
+    return wsgi.BUSY_TEXT
+
+
+async def answer_chat(mem_agent: Optional[AsyncMemoryAgent], whatsapp_msg):
+    last = as_batch(whatsapp_msg)[-1]
+    if mem_agent is None:
+        await last.areply(await fallback_reply(None, whatsapp_msg))
+        return
+    try:
+        if wsgi.REPLY_STREAMING != "off":
+            with metrics.stage("agent_stream"):
+                if (await last.astream_reply(mem_agent.stream_message(whatsapp_msg))).strip():
+                    return
+            raise ValueError("the agent streamed no reply text")
+        with metrics.stage("agent_call"):
+            response = await mem_agent.send_message(whatsapp_msg)
+    except Exception as e:
+        if last.stream_started():
+            raise
+        logger.warning(f"Memory agent could not answer {last._from}, answering without it: {e}")
+        response = await fallback_reply(mem_agent, whatsapp_msg)
+    await last.areply(str(response))
+
+
+async def answer_batch(key, whatsapp_msgs):
+    session, chat_id, _ = key
+    try:
+        mem_agent = await try_memory_agent(chat_id, session)
+        await answer_chat(mem_agent, whatsapp_msgs)
+    finally:
+        _debouncer.done(key)
+
+
+def submit_batch(key, whatsapp_msgs):
+    session, chat_id, _ = key
+    try:
+        get_runner(session).submit(chat_id, answer_batch, key, whatsapp_msgs)
+    except QueueFullError as e:
+        logger.error(f"Dropping {len(whatsapp_msgs)} debounced messages for {chat_id}: {e}")
+        _debouncer.done(key)
+
+
+_loop: asyncio.AbstractEventLoop = None
+# the debouncer times batches on its own thread and hands them back to the event loop
+_debouncer = Debouncer(window=wsgi.CHAT_DEBOUNCE, max_wait=wsgi.CHAT_DEBOUNCE_MAX_WAIT,
+                       on_ready=lambda key, msgs: _loop.call_soon_threadsafe(submit_batch, key, msgs),
+                       name="async-chat-debounce")
+
+
+async def get_memory_agent(recipient: str, session: str = DEFAULT_SESSION) -> AsyncMemoryAgent:
+    registry = get_session(session).agents
+    agent = registry.peek(recipient)
+    if agent is None:
+        # creating an agent is a one-off per chat, run it off the loop
+        agent = await asyncio.to_thread(registry.get, recipient)
+    return agent
+
+
+async def try_memory_agent(recipient: str, session: str = DEFAULT_SESSION) -> Optional[AsyncMemoryAgent]:
+    try:
+        return await get_memory_agent(recipient, session)
+    except Exception as e:
+        logger.warning(f"No memory agent for {recipient}: {e}")
+        return None
+
+
+async def process_message(payload, action: str = "process", session: str = DEFAULT_SESSION):
+    if action == "remember":
+        if PASSAGE_WRITE_BEHIND:
+            return remember_message(payload, session)
+        return await asyncio.to_thread(remember_message, payload, session)
+
+    whatsapp_msg = await WhatsappMSG.from_payload(payload, session=session)
+    mem_agent = await try_memory_agent(whatsapp_msg._from, session)
+    with metrics.stage("remember"):
+        if mem_agent is not None:
+            await mem_agent.aremember(text=whatsapp_msg.message,
+                                      role=whatsapp_msg.contact.name or "unknown")
+        else:
+            # queued for the passage writer, which loads the agent once the memory server is back
+            await asyncio.to_thread(get_session(session).agents.remember, whatsapp_msg._from,
+                                    whatsapp_msg.message, whatsapp_msg.contact.name or "unknown")
+
+    if not whatsapp_msg.is_valid():
+        return "ignored"
+
+    route = whatsapp_msg.route()
+    if route == "chat":
+        await whatsapp_msg.load_media()
+        if wsgi.CHAT_DEBOUNCE > 0:
+            _debouncer.add(wsgi.debounce_key(session, whatsapp_msg), whatsapp_msg)
+            return "debounced"
+        await answer_chat(mem_agent, whatsapp_msg)
+    elif route == "dalle":
+        dalle = AsyncDalle()
+        dalle.context = await recent_context(mem_agent)
+
+        dalle.prompt = whatsapp_msg.message[len(
+            config.dalle_prefix):].strip()
+        image_url = dalle.cached()
+        if image_url:
+            await asyncio.wrap_future(send_image(session, whatsapp_msg.recipient, image_url))
+            return "ok"
+        await whatsapp_msg.areply(wsgi.DALLE_PENDING_TEXT)
+        try:
+            _image_jobs.submit(whatsapp_msg.recipient, generate_image, dalle, session, whatsapp_msg.recipient)
+        except QueueFullError as e:
+            logger.warning(f"Rejecting image request: {e}")
+            await whatsapp_msg.areply(wsgi.DALLE_FAILED_TEXT)
+            return "busy"
+        return "generating"
+    else:
+        logger.debug("Message did not match any route: %s", whatsapp_msg.message)
+        return "no matching handler"
+    return "ok"
+
+
+async def handle_message(payload, action: str = "process", session: str = DEFAULT_SESSION):
+    with metrics.stage(f"message_{action}"):
+        return await process_message(payload, action, session)
+
+
+@app.before_serving
+async def startup():
+    global _loop
+    _loop = asyncio.get_running_loop()
+
+
+@app.after_serving
+async def shutdown():
+    _debouncer.stop()
+    # let the batches it just released reach their runners
+    await asyncio.sleep(0)
+    for runner in list(_runners.values()):
+        await runner.stop()
+    await _image_jobs.stop()
+    await http_client.close_async_session()
+    await close_async_letta_client()
+    if wsgi._router:
+        await wsgi._router.aclose()
+
+
+@app.route("/health", methods=["GET"])
+async def health():
+    return jsonify({
+        "status": "up",
+        "sessions": {name: dict(session.stats(), queue=get_runner(name).stats())
+                     for name, session in list(wsgi._sessions.items())},
+        "passages": passage_stats(),
+        "cache": {"shared": get_backend().stats()},
+        "dedup": _dedup.stats() if _dedup else None,
+        "outbound": wsgi._outbound.stats(),
+        "images": {"queue": _image_jobs.stats(), "cache": dalle_cache_stats()},
+        "debounce": _debouncer.stats(),
+        "circuits": breaker_stats(),
+        "shard": wsgi._router.stats() if wsgi._router else None,
+        "journal": wsgi._journal_drainer.stats() if wsgi._journal_drainer else None,
+    }), 200
+
+
+@app.route("/metrics", methods=["GET"])
+async def prometheus_metrics():
+    queues = {name: get_runner(name).stats() for name in list(wsgi._sessions)}
+    queues["images"] = _image_jobs.stats()
+    return Response(metrics.render(metric_families(queues)), content_type=metrics.CONTENT_TYPE)
+
+
+def respond(answer: wsgi.Answer):
+    body, code, headers = answer
+    return jsonify(body), code, headers
+
+
+@app.route("/webhook", methods=["POST"])
+async def webhook():
+    admission = admit_webhook(await request.get_json(silent=True), forwarded=FORWARDED_HEADER in request.headers)
+    if admission.broadcast:
+        app.add_background_task(wsgi._router.abroadcast, await request.get_data())
+    if admission.answer:
+        return respond(admission.answer)
+
+    if admission.owner is not None:
+        try:
+            status, data, headers = await wsgi._router.aforward(admission.owner, await request.get_data())
+        except httpx.HTTPError as e:
+            return respond(wsgi.forward_failed(admission.owner, e))
+        metrics.WEBHOOKS.inc("forwarded")
+        return Response(data, status=status, headers=headers)
+
+    if WEBHOOK_MODE == "queued":
+        try:
+            get_runner(admission.session).submit(admission.sender, handle_message, admission.payload,
+                                                 admission.action, admission.session)
+        except QueueFullError as e:
+            return respond(admission.rejected(e))
+        return respond(wsgi.webhook_answer("queued", 202))
+
+    try:
+        return respond(wsgi.webhook_answer(await handle_message(admission.payload, admission.action,
+                                                                admission.session)))
+    except CircuitOpenError as e:
+        return respond(admission.deferred(e))
+    except Exception as e:
+        admission.failed(e)
+        raise
+
+
+@app.route("/pair", methods=["GET"])
+async def pair():
+    session_name = request.args.get("session", DEFAULT_SESSION)
+    if not wsgi.is_served(session_name):
+        return "Unknown session.", 400
+
+    status_data = (await async_send_request("GET", f"/api/sessions/{session_name}")).json()
+    logger.debug(f"Status data: {status_data}")
+    if wsgi.is_connected(status_data):
+        return f"<h1>Session '{session_name}' is already connected.</h1>", 200
+
+    if status_data.get("status") != "SCAN_QR_CODE":
+        await async_send_request(method="POST", endpoint="/api/sessions/start", payload={"name": session_name})
+        await async_send_request("PUT", f"/api/sessions/{session_name}", wsgi.session_config())
+
+    return wsgi.qr_page((await async_send_request("GET", f"/api/{session_name}/auth/qr")).content)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("asgi_app:app", host="0.0.0.0", port=5002)
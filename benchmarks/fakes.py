@@ -0,0 +1,232 @@
+"""Local stand-ins for WAHA, the Letta memory server and the OpenAI images API.
+
+Each fake is a threaded HTTP server on a free localhost port that answers
+the calls the bot makes after a configurable delay, failing a configurable
+share of them with a 500, so load tests need neither network nor keys.
+"""
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+# JPEG markers around some padding; the bot only base64 encodes it
+FAKE_IMAGE = b"\xff\xd8\xff\xe0" + bytes(2048) + b"\xff\xd9"
+
+
+class Behaviour:
+    """Latency (seconds, +-50% jitter) and error rate of a fake server."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+    def delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def fails(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class FakeServer:
+    def __init__(self, behaviour: Optional[Behaviour] = None):
+        self.behaviour = behaviour or Behaviour()
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "FakeServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method: str, path: str, query: Dict, body) -> tuple:
+        """Return (status, content type, body bytes) for one request."""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw else None
+                except ValueError:
+                    body = None
+                parsed = urlparse(self.path)
+                with fake._lock:
+                    fake.requests += 1
+                fake.behaviour.delay()
+                if fake.behaviour.fails():
+                    with fake._lock:
+                        fake.errors += 1
+                    status, content_type, data = 500, "application/json", b'{"error": "injected failure"}'
+                else:
+                    status, content_type, data = fake.handle(self.command, parsed.path, parse_qs(parsed.query), body)
+                try:
+                    self._respond(status, content_type, data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up (timeout, size limit), nothing to answer
+                    self.close_connection = True
+
+            def _respond(self, status, content_type, data):
+                if callable(data):
+                    # streamed answer: the callable writes the body itself
+                    self.send_response(status)
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    data(self.wfile)
+                    self.close_connection = True
+                    return
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def _json(data, status: int = 200) -> tuple:
+    return status, "application/json", json.dumps(data).encode()
+
+
+class FakeWAHA(FakeServer):
+    """Contacts, groups, media files and the send/typing/edit endpoints.
+
+    ``on_send(chat_id, endpoint, text)`` is called for every message the bot
+    sends, which is how the load test measures reply latency.
+    """
+
+    def __init__(self, behaviour: Optional[Behaviour] = None,
+                 on_send: Optional[Callable[[str, str, str], None]] = None):
+        super().__init__(behaviour)
+        self.on_send = on_send
+        self.sent = 0
+        self._ids = itertools.count(1)
+
+    def handle(self, method, path, query, body):
+        body = body or {}
+        if path == "/api/contacts":
+            contact_id = query.get("contactId", [""])[0]
+            return _json({"id": contact_id, "name": "Me", "pushname": "Me", "isMyContact": True,
+                          "number": contact_id.split("@")[0], "isUser": True})
+        if "/groups/" in path:
+            group_id = path.rsplit("/", 1)[-1]
+            return _json({"id": group_id, "name": f"Group {group_id[:6]}", "participants": []})
+        if path.startswith("/api/files/"):
+            return 200, "image/jpeg", FAKE_IMAGE
+        if path in ("/api/sendText", "/api/sendImage"):
+            with self._lock:
+                self.sent += 1
+            if self.on_send:
+                self.on_send(body.get("chatId", ""), path, body.get("text", ""))
+            return _json({"id": {"_serialized": f"true_{body.get('chatId', '')}_{next(self._ids)}"}})
+        if path in ("/api/startTyping", "/api/stopTyping") or method == "PUT":
+            return _json({})
+        return _json({"error": f"not faked: {method} {path}"}, status=404)
+
+
+class FakeLetta(FakeServer):
+    """Agents, archival passages, models and (streamed) agent messages.
+
+    Responses carry only the fields the bot reads; letta_client builds its
+    models from them without validation.
+    """
+
+    def __init__(self, behaviour: Optional[Behaviour] = None, reply: str = "This is a fake answer. " * 4,
+                 stream_chunks: int = 8):
+        super().__init__(behaviour)
+        self.reply = reply
+        self.stream_chunks = stream_chunks
+        self.agents: Dict[str, dict] = {}
+        self.passages = 0
+        self._ids = itertools.count(1)
+
+    def _message(self, content: str) -> dict:
+        return {"id": f"message-{next(self._ids)}", "date": "2024-01-01T00:00:00Z",
+                "message_type": "assistant_message", "content": content}
+
+    def handle(self, method, path, query, body):
+        if path == "/v1/models/":
+            return _json([{"model": "gpt-4.1-mini", "model_endpoint_type": "openai", "context_window": 128000}])
+        if path == "/v1/agents/" and method == "GET":
+            name = query.get("name", [None])[0]
+            with self._lock:
+                agents = [agent for agent in self.agents.values() if name is None or agent["name"] == name]
+            return _json(agents)
+        if path == "/v1/agents/" and method == "POST":
+            agent = {"id": f"agent-{next(self._ids)}", "name": (body or {}).get("name", "")}
+            with self._lock:
+                self.agents[agent["id"]] = agent
+            return _json(agent)
+        if path.endswith("/archival-memory") and method == "POST":
+            with self._lock:
+                self.passages += 1
+            return _json([{"id": f"passage-{next(self._ids)}", "text": (body or {}).get("text", "")}])
+        if path.endswith("/messages") and method == "GET":
+            return _json([])
+        if path.endswith("/messages") and method == "POST":
+            return _json({"messages": [self._message(self.reply)], "stop_reason": {"stop_reason": "end_turn"}})
+        if path.endswith("/messages/stream"):
+            return 200, "text/event-stream", self._stream
+        return _json({"detail": f"not faked: {method} {path}"}, status=404)
+
+    def _stream(self, out):
+        # first token after one latency, then one more latency per chunk
+        size = max(1, len(self.reply) // self.stream_chunks)
+        for start in range(0, len(self.reply), size):
+            out.write(f"data: {json.dumps(self._message(self.reply[start:start + size]))}\n\n".encode())
+            out.flush()
+            self.behaviour.delay()
+        out.write(b"data: [DONE]\n\n")
+        out.flush()
+
+
+class FakeOpenAI(FakeServer):
+    """``images.generate``, answering with a URL served by the fake WAHA, and chat completions."""
+
+    def __init__(self, behaviour: Optional[Behaviour] = None, image_url: str = "http://127.0.0.1/fake.png"):
+        super().__init__(behaviour)
+        self.image_url = image_url
+        self.images = 0
+
+    def handle(self, method, path, query, body):
+        if path.endswith("/chat/completions"):
+            return _json({"id": f"chatcmpl-{time.time_ns()}", "object": "chat.completion", "created": int(time.time()),
+                          "model": (body or {}).get("model", ""),
+                          "choices": [{"index": 0, "finish_reason": "stop",
+                                       "message": {"role": "assistant", "content": "A fake answer without memory."}}]})
+        if path.endswith("/images/generations"):
+            with self._lock:
+                self.images += 1
+            return _json({"created": int(time.time()), "data": [{"url": self.image_url}]})
+        return _json({"error": {"message": f"not faked: {method} {path}"}}, status=404)
@@ -0,0 +1,363 @@
+"""Drive /webhook with a mix of messages against fake WAHA, Letta and OpenAI servers.
+
+The bot runs as a subprocess (Flask or ASGI) in a scratch directory with
+a generated .env pointing at the fakes, so a run needs no network, keys or
+running services. The report has throughput, webhook and reply latency
+measured here, and per-stage and per-downstream-call percentiles taken
+from the bot's /metrics histograms.
+
+    python -m benchmarks.load_test --messages 2000 --concurrency 32 --letta-latency 0.5
+    python -m benchmarks.load_test --server asgi --env REPLY_STREAMING=chunks --json run.json
+    python -m benchmarks.load_test --workers 4 --messages 5000 --concurrency 64
+"""
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+from benchmarks.fakes import Behaviour, FakeLetta, FakeOpenAI, FakeWAHA
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT_PREFIX = "??"
+DALLE_PREFIX = "!!"
+PENDING_TEXT = "Generating image…"
+QUANTILES = (0.50, 0.95, 0.99)
+_SAMPLE = re.compile(r"^(\w+)(?:\{(.*)\})? (\S+)$")
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def histogram_quantile(buckets: List[tuple], q: float) -> float:
+    """Quantile of a cumulative [(upper bound, count), ...] histogram, interpolated like Prometheus does."""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return 0.0
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(count - below, 1)
+        lower, below = bound, count
+    return lower
+
+
+def parse_histograms(text: str, name: str, key_labels: tuple) -> Dict[str, dict]:
+    """Histogram series of ``name`` from Prometheus text, keyed by the joined ``key_labels``.
+
+    Repeated series, as in the scrapes of several workers put together, are added up.
+    """
+    series = defaultdict(lambda: {"buckets": defaultdict(float), "sum": 0.0, "count": 0})
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if not match or not match.group(1).startswith(name):
+            continue
+        metric, labels, value = match.group(1), dict(_LABEL.findall(match.group(2) or "")), float(match.group(3))
+        key = " ".join(labels.get(label, "") for label in key_labels)
+        if metric == f"{name}_bucket":
+            series[key]["buckets"][float(labels["le"])] += value
+        elif metric == f"{name}_sum":
+            series[key]["sum"] += value
+        elif metric == f"{name}_count":
+            series[key]["count"] += int(value)
+    return {key: dict(data, buckets=sorted(data["buckets"].items())) for key, data in series.items()}
+
+
+def summarize(series: Dict[str, dict]) -> Dict[str, dict]:
+    return {key: dict({f"p{int(q * 100)}": histogram_quantile(data["buckets"], q) for q in QUANTILES},
+                      count=data["count"], mean=data["sum"] / data["count"] if data["count"] else 0.0)
+            for key, data in sorted(series.items())}
+
+
+class ReplyTracker:
+    """Matches messages the bot sends to the webhook posts they answer, oldest first per chat."""
+
+    def __init__(self):
+        self._waiting: Dict[tuple, deque] = defaultdict(deque)
+        self._lock = threading.Lock()
+        self.expected = 0
+        self.latencies: List[float] = []
+        self.last_reply = time.monotonic()
+
+    def expect(self, chat_id: str, kind: str, posted_at: float):
+        with self._lock:
+            self._waiting[(chat_id, kind)].append(posted_at)
+            self.expected += 1
+
+    def on_send(self, chat_id: str, endpoint: str, text: str):
+        now = time.monotonic()
+        if text == PENDING_TEXT:
+            return
+        kind = "image" if endpoint == "/api/sendImage" else "chat"
+        with self._lock:
+            self.last_reply = now
+            waiting = self._waiting.get((chat_id, kind))
+            if waiting:
+                self.latencies.append(now - waiting.popleft())
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(waiting) for waiting in self._waiting.values())
+
+
+def make_payload(index: int, rng: random.Random, args, run_id: str, waha_url: str) -> tuple:
+    chat = rng.randrange(args.chats)
+    is_group = rng.random() < args.group_ratio
+    chat_id = f"1203630{chat:011d}@g.us" if is_group else f"9725{chat:08d}@c.us"
+    message_id = f"false_{chat_id}_{run_id}{index:07d}"
+    roll = rng.random()
+    if roll < args.dalle_ratio:
+        kind, body = "image", f"{DALLE_PREFIX} a drawing of message {index}"
+    elif roll < args.dalle_ratio + args.prefixed_ratio:
+        kind, body = "chat", f"{CHAT_PREFIX} question number {index}, what do you think?"
+    else:
+        kind, body = None, f"just chatting, message {index}"
+
+    payload = {"id": message_id, "from": chat_id, "to": chat_id, "fromMe": False, "body": body,
+               "timestamp": int(time.time()), "hasMedia": False, "_data": {"notifyName": f"Bench {chat}"}}
+    if is_group:
+        payload["participant"] = f"9725{rng.randrange(args.chats):08d}@c.us"
+    if rng.random() < args.media_ratio:
+        payload["hasMedia"] = True
+        payload["media"] = {"url": f"{waha_url}/api/files/default/{message_id}.jpeg", "mimetype": "image/jpeg"}
+    if rng.random() < args.quote_ratio:
+        if rng.random() < 0.5:
+            payload["_data"]["quotedMsg"] = {"type": "chat", "body": "an earlier message"}
+        else:
+            payload["_data"]["quotedMsg"] = {"type": "image", "mimetype": "image/jpeg"}
+            payload["_data"]["quotedStanzaID"] = f"Q{index:07d}"
+            payload["_data"]["quotedParticipant"] = chat_id
+    return chat_id, kind, {"event": "message", "session": "default", "payload": payload}
+
+
+def free_port(count: int = 1) -> int:
+    """First of ``count`` consecutive ports that are free right now."""
+    while True:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        if port + count <= 65536 and all(port_is_free(port + offset) for offset in range(1, count)):
+            return port
+
+
+def port_is_free(port: int) -> bool:
+    with socket.socket() as sock:
+        try:
+            sock.bind(("127.0.0.1", port))
+        except OSError:
+            return False
+    return True
+
+
+def write_env(directory: str, waha: FakeWAHA, letta: FakeLetta, openai: FakeOpenAI, overrides: List[str]):
+    settings = {
+        "LOG_LEVEL": "WARNING",
+        "WAHA_API_URL": waha.url,
+        "WAHA_API_KEY": "bench",
+        "WEBHOOK_URL": "http://127.0.0.1/webhook",
+        "LETTA_BASE_URL": letta.url,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{openai.url}/v1",
+        "DALLE_MODEL": "dall-e-3",
+        "CHAT_PREFIX": CHAT_PREFIX,
+        "DALLE_PREFIX": DALLE_PREFIX,
+        "DALLE_PENDING_TEXT": PENDING_TEXT,
+    }
+    for override in overrides:
+        key, _, value = override.partition("=")
+        settings[key.strip()] = value.strip()
+    with open(os.path.join(directory, ".env"), "w") as file:
+        file.writelines(f"{key}={value}\n" for key, value in settings.items())
+
+
+def start_server(kind: str, directory: str, port: int, workers: int = 1) -> subprocess.Popen:
+    if workers > 1:
+        command = [sys.executable, os.path.join(ROOT, "serve.py"), "--workers", str(workers), "--server", kind,
+                   "--host", "127.0.0.1", "--port", str(port)]
+    elif kind == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi_app:app", "--host", "127.0.0.1", "--port", str(port),
+                   "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "flask", "--app", "app", "run", "--host", "127.0.0.1", "--port", str(port),
+                   "--no-reload", "--no-debugger", "--with-threads"]
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    log = open(os.path.join(directory, "server.log"), "w")
+    return subprocess.Popen(command, cwd=directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with {process.returncode}")
+        try:
+            if requests.get(f"{url}/health", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server did not come up within {timeout:.0f}s")
+
+
+def drive(url: str, args, tracker: ReplyTracker, waha_url: str) -> dict:
+    rng = random.Random(args.seed)
+    run_id = f"B{int(time.time()) % 100000:05d}"
+    messages = [make_payload(index, rng, args, run_id, waha_url) for index in range(args.messages)]
+    acks: List[float] = []
+    statuses: Dict[int, int] = defaultdict(int)
+    lock = threading.Lock()
+    local = threading.local()
+    started = time.monotonic()
+
+    def post(index: int):
+        if args.rate > 0:
+            delay = started + index / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        chat_id, kind, body = messages[index]
+        posted_at = time.monotonic()
+        if kind:
+            tracker.expect(chat_id, kind, posted_at)
+        try:
+            status = session.post(f"{url}/webhook", json=body, timeout=60).status_code
+        except requests.RequestException:
+            status = 0
+        with lock:
+            acks.append(time.monotonic() - posted_at)
+            statuses[status] += 1
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(post, range(args.messages)))
+    sent_in = time.monotonic() - started
+
+    # replies keep arriving after the last webhook is acknowledged
+    while tracker.pending() and time.monotonic() - tracker.last_reply < args.drain_timeout:
+        time.sleep(0.1)
+    finished = time.monotonic() - started
+    return {
+        "messages": args.messages,
+        "duration": finished,
+        "webhooks_per_second": args.messages / sent_in if sent_in else 0.0,
+        "replies_per_second": len(tracker.latencies) / finished if finished else 0.0,
+        "statuses": dict(statuses),
+        "webhook_latency": {f"p{int(q * 100)}": percentile(acks, q) for q in QUANTILES},
+        "replies": {"expected": tracker.expected, "received": len(tracker.latencies)},
+        "reply_latency": {f"p{int(q * 100)}": percentile(tracker.latencies, q) for q in QUANTILES},
+    }
+
+
+def print_table(title: str, rows: Dict[str, dict]):
+    print(f"\n{title}")
+    print(f"  {'':44} {'count':>8} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for key, row in rows.items():
+        print(f"  {key:44} {row['count']:>8} {row['p50'] * 1000:>7.1f}ms {row['p95'] * 1000:>7.1f}ms "
+              f"{row['p99'] * 1000:>7.1f}ms")
+
+
+def report(result: dict):
+    print(f"{result['messages']} messages in {result['duration']:.1f}s: "
+          f"{result['webhooks_per_second']:.1f} webhooks/s, {result['replies_per_second']:.1f} replies/s")
+    print(f"HTTP statuses: {result['statuses']}")
+    print(f"replies received: {result['replies']['received']} of {result['replies']['expected']}")
+    for name in ("webhook_latency", "reply_latency"):
+        latency = result[name]
+        print(f"{name.replace('_', ' ')}: " + ", ".join(f"{q} {value * 1000:.1f}ms" for q, value in latency.items()))
+    print_table("stages", result["stages"])
+    print_table("downstream calls", result["downstream"])
+    print(f"\nfakes: {json.dumps(result['fakes'])}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, started with serve.py")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16, help="webhook posts in flight")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 for as fast as possible")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--group-ratio", type=float, default=0.3)
+    parser.add_argument("--prefixed-ratio", type=float, default=0.3, help="share of messages for the agent")
+    parser.add_argument("--dalle-ratio", type=float, default=0.02, help="share of image requests")
+    parser.add_argument("--media-ratio", type=float, default=0.1)
+    parser.add_argument("--quote-ratio", type=float, default=0.1)
+    parser.add_argument("--waha-latency", type=float, default=0.01)
+    parser.add_argument("--letta-latency", type=float, default=0.2)
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake calls answered with a 500")
+    for service in ("waha", "letta", "openai"):
+        parser.add_argument(f"--{service}-error-rate", type=float, help=f"error rate of the {service} fake only")
+    parser.add_argument("--drain-timeout", type=float, default=10.0,
+                        help="stop waiting for replies after this many seconds without one")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra .env setting for the bot, may be repeated")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    tracker = ReplyTracker()
+    def error_rate(service: str) -> float:
+        rate = getattr(args, f"{service}_error_rate")
+        return args.error_rate if rate is None else rate
+
+    waha = FakeWAHA(Behaviour(args.waha_latency, error_rate("waha")), on_send=tracker.on_send).start()
+    letta = FakeLetta(Behaviour(args.letta_latency, error_rate("letta"))).start()
+    openai = FakeOpenAI(Behaviour(args.openai_latency, error_rate("openai")), image_url=f"{waha.url}/fake.png").start()
+
+    with tempfile.TemporaryDirectory(prefix="whatsapp-gpt-bench-") as directory:
+        write_env(directory, waha, letta, openai, args.env)
+        port = free_port(args.workers)
+        url = f"http://127.0.0.1:{port}"
+        worker_urls = [f"http://127.0.0.1:{port + index}" for index in range(args.workers)]
+        process = start_server(args.server, directory, port, args.workers)
+        try:
+            for worker_url in worker_urls:
+                wait_until_up(worker_url, process)
+            result = drive(url, args, tracker, waha.url)
+            metrics = "".join(requests.get(f"{worker_url}/metrics", timeout=10).text for worker_url in worker_urls)
+        except Exception:
+            with open(os.path.join(directory, "server.log")) as log:
+                sys.stderr.write(log.read())
+            raise
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            for fake in (waha, letta, openai):
+                fake.stop()
+
+    result["stages"] = summarize(parse_histograms(metrics, "whatsapp_stage_duration_seconds", ("stage",)))
+    result["downstream"] = summarize(parse_histograms(metrics, "whatsapp_downstream_duration_seconds",
+                                                      ("service", "operation")))
+    result["fakes"] = {"waha": waha.stats(), "letta": letta.stats(), "openai": openai.stats()}
+    report(result)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(dict(result, args=vars(args)), file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,8 @@ class Config:
 
     def _load_env_file(self, path: str):
         if not os.path.isfile(path):
-            raise FileNotFoundError(f"{path} does not exist.")
+            # a container or a worker started by serve.py may get all its settings from the environment
+            return
 
         with open(path, "r") as file:
             for line in file:
@@ -26,6 +27,19 @@ class Config:
     def __getattr__(self, name: str):
         if name in self._attributes:
             return self._attributes[name]
+        if name.upper() in os.environ:
+            return os.environ[name.upper()]
         raise AttributeError(f"'Config' object has no attribute '{name}'")
+
+    def get(self, name: str, default=None, cast=None):
+        value = self._attributes.get(name, self._attributes.get(name.lower()))
+        if value is None:
+            # settings missing from .env can come from the environment, e.g. a worker's SHARD_INDEX
+            value = os.environ.get(name.upper())
+        if value is None or value == "":
+            return default
+        if cast is bool:
+            return value.lower() in ("1", "true", "yes", "on")
+        return cast(value) if cast else value
                 
 config = Config()
\ No newline at end of file
@@ -1,43 +1,221 @@
-from letta_client import AgentState, EmbeddingConfig, Letta, MessageCreate, MessageCreateContent, TextContent, ImageContent, CreateBlock
-from letta_client.types.agent_state import AgentState
-from typing import Union
-from letta_client import Base64Image, ImageContent, TextContent
+import asyncio
+import atexit
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, Iterator, List, Optional, Union
+
+from config import config
+from utiles import metrics
+from utiles.cache_backend import get_backend
+from utiles.circuit_breaker import get_breaker, is_failure
+from utiles.journal import get_journal
 from utiles.logger import Logger
+from utiles.context_buffer import ContextBuffer
+from utiles.write_behind import WriteBehindBuffer
+
+if TYPE_CHECKING:
+    # letta_client takes most of a second to import, so it is loaded with the first client
+    import httpx
+    from letta_client import AgentState, AsyncLetta, ImageContent, Letta, MessageCreate, TextContent
 
 
 SUPPORTED_MEDIA_TYPES = {"image/jpeg", "image/png"}
 logger = Logger()
 
+LETTA_BASE_URL = config.get("letta_base_url", "http://localhost:8283")
+CONTEXT_MAX_CHARS = config.get("context_max_chars", 3500, int)
+CONTEXT_MAX_TOKENS = config.get("context_max_tokens", None, int)
+PASSAGE_WRITE_BEHIND = config.get("passage_write_behind", True, bool)
+PASSAGE_MERGE_BATCH = config.get("passage_merge_batch", True, bool)
+REPLY_STREAM_TOKENS = config.get("reply_stream_tokens", True, bool)
+_passage_buffer = WriteBehindBuffer(max_items=config.get("passage_batch_size", 20, int),
+                                    max_age=config.get("passage_flush_interval", 5.0, float),
+                                    dedup_window=config.get("passage_dedup_window", 50, int),
+                                    name="passage-writer")
+atexit.register(_passage_buffer.stop)
+
+
+def passage_stats() -> dict:
+    return _passage_buffer.stats()
+
+
+_letta_breaker = get_breaker("letta")
+
+
+@contextmanager
+def letta_call(operation: str):
+    """Times a memory server call and runs it through the memory server's circuit breaker."""
+    with _letta_breaker.guard(), metrics.downstream("letta", operation):
+        yield
+
+
+_client: Optional["Letta"] = None
+_async_client: Optional["AsyncLetta"] = None
+_async_http: Optional["httpx.AsyncClient"] = None
+_models: Optional[list] = None
+_client_lock = threading.Lock()
+
+
+def get_letta_client() -> "Letta":
+    """One Letta client (and connection pool) shared by every agent in the process, created on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import httpx
+                from letta_client import Letta
+
+                pool_size = config.get("letta_pool_size", 20, int)
+                timeout = config.get("letta_timeout", 60.0, float)
+                _client = Letta(
+                    base_url=LETTA_BASE_URL,
+                    timeout=timeout,
+                    httpx_client=httpx.Client(
+                        timeout=timeout,
+                        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                    ),
+                )
+    return _client
+
+
+def get_async_letta_client() -> "AsyncLetta":
+    # like the async WAHA session, this belongs to the one ASGI event loop
+    global _async_client, _async_http
+    if _async_client is None:
+        import httpx
+        from letta_client import AsyncLetta
+
+        pool_size = config.get("letta_pool_size", 20, int)
+        timeout = config.get("letta_timeout", 60.0, float)
+        _async_http = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        _async_client = AsyncLetta(base_url=LETTA_BASE_URL, timeout=timeout, httpx_client=_async_http)
+    return _async_client
+
+
+async def close_async_letta_client():
+    global _async_client, _async_http
+    if _async_http is not None:
+        await _async_http.aclose()
+    _async_client = _async_http = None
+
+
+def list_models(client: "Letta") -> list:
+    global _models
+    if _models is None:
+        with _client_lock:
+            if _models is None:
+                with letta_call("models.list"):
+                    _models = list(client.models.list())
+    return _models
+
+
+def assistant_delta(chunk) -> str:
+    """Text carried by an assistant message chunk of a stream, "" for any other step."""
+    if getattr(chunk, "message_type", None) != "assistant_message":
+        return ""
+    content = chunk.content
+    if isinstance(content, str):
+        return content
+    return "".join(part.text for part in content if getattr(part, "text", None))
+
+
+def list_agents(page_size: int = 1000) -> List["AgentState"]:
+    """All agents on the memory server, fetched page by page; also primes the model list."""
+    client = get_letta_client()
+    result = []
+    after = None
+    while True:
+        with letta_call("agents.list"):
+            agents = client.agents.list(limit=page_size, after=after) if after else client.agents.list(limit=page_size)
+        result.extend(agents)
+        if len(agents) < page_size:
+            break
+        after = agents[-1].id
+    list_models(client)
+    return result
+
+
+def durable_writer(session: str, recipient: str, write: Callable[[List[str]], None]) -> Callable[[List[str]], None]:
+    """Passage writer that journals a batch the memory server can't take, to be replayed once it is back."""
+    def writer(lines: List[str]):
+        try:
+            write(lines)
+        except Exception as e:
+            journal = get_journal()
+            if journal is None or not is_failure(e):
+                raise
+            journal.append("passage", {"session": session, "recipient": recipient, "lines": lines})
+            logger.warning(f"Journaled {len(lines)} passages for {recipient} until the memory server is back: {e}")
+    return writer
+
+
+def as_batch(whatsapp_msg) -> list:
+    return whatsapp_msg if isinstance(whatsapp_msg, list) else [whatsapp_msg]
+
+
+def clip_passage(text: str) -> str:
+    return text[:1000] + "..." if len(text) > 1000 else text
+
+
+def chat_id_for(recipient: str, session: str = "default") -> str:
+    chat_id = recipient.replace("@", "_").replace(".", "_")
+    # agents of the default session keep their original names
+    return chat_id if session == "default" else f"{session}__{chat_id}"
+
 
 class MemoryAgent:
-    def __init__(self, recipient: str):
+    def __init__(self, recipient: str, agent: Optional["AgentState"] = None, session: str = "default"):
         self.llm_model_name = "gpt-4.1-mini"
         self.model = None
         self.recipient = recipient
-        self.chat_id = recipient.replace("@", "_").replace(".", "_")
-        self.client = Letta(base_url="http://localhost:8283")
-        self.agent: AgentState = self.get_agent()
-        logger.debug(
-            f"Initialized MemoryAgent for {self.chat_id} with agent ID {self.agent.name}")
+        self.session = session
+        self.chat_id = chat_id_for(recipient, session)
+        self.client = get_letta_client()
+        self.agent: "AgentState" = agent or self.get_agent()
+        self.context = ContextBuffer(max_chars=CONTEXT_MAX_CHARS, max_tokens=CONTEXT_MAX_TOKENS)
+        self._writer = durable_writer(session, recipient, self._write_passages)
+        logger.debug("Initialized MemoryAgent for %s with agent ID %s", self.chat_id, self.agent.name)
 
     def remember(self, text: str, role: str):
         pass
         if not text:
             return
 
-        if len(text) > 1000:
-            text = text[:1000] + "..."
+        text = clip_passage(text)
+        if not PASSAGE_WRITE_BEHIND:
+            try:
+                self._write_passages([f"[{role}]: {text}"])
+                return
+            except Exception as e:
+                # the writer thread retries it once the memory server is back
+                logger.warning(f"Queueing passage for {self.chat_id} for later: {e}")
 
-        self.client.agents.passages.create(
-            agent_id=self.agent.id,
-            text=f"[{role}]: {text}"
-        )
+        _passage_buffer.add(self.chat_id, role, text, writer=self._writer)
+        logger.debug("Buffered text for %s: [%s]: %s", self.agent.name, role, text)
 
-        logger.debug(
-            f"Remembered text for {self.agent.name}: [{role}]: {text}")
+    def _write_passages(self, lines: List[str]):
+        # the memory server has no bulk insert, so a batch is stored as one passage (one embedding)
+        batches = ["\n".join(lines)] if PASSAGE_MERGE_BATCH else lines
+        for text in batches:
+            with letta_call("passages.create"):
+                self.client.agents.passages.create(
+                    agent_id=self.agent.id,
+                    text=text
+                )
+
+        logger.debug("Remembered %d lines for %s", len(lines), self.agent.name)
+
+    def flush(self):
+        _passage_buffer.flush(self.chat_id)
 
     def get_models(self):
-        models = self.client.models.list()
+        models = list_models(self.client)
         for model in models:
             if model.model == self.llm_model_name:
                 self.model = model
@@ -45,31 +223,42 @@ class MemoryAgent:
         raise ValueError(
             f"Model {self.llm_model_name} not found in available models.")
 
-    def get_agent(self) -> AgentState:
-        agents = self.client.agents.list(name=self.chat_id)
-        return agents[0] if agents else self.set_agent()
-
-    def set_agent(self) -> AgentState:
-        return self.client.agents.create(
-            name=self.chat_id,
-            llm_config=self.model if self.model else self.get_models(),
-            embedding_config=EmbeddingConfig(
-                embedding_endpoint_type="openai",
-                embedding_model="text-embedding-3-small",
-                embedding_dim=1024,
-            ),
-            memory_blocks=[
-                CreateBlock(value="", label="human"),
-                CreateBlock(value="", label="persona")
-            ],
-            enable_sleeptime=True
-        )
+    def get_agent(self) -> "AgentState":
+        # looking up and creating under one per-chat lock, shared by all worker processes with
+        # CACHE_BACKEND=sqlite, so two of them never both find no agent and both create one
+        with get_backend().lock(f"agent:{self.chat_id}"):
+            with letta_call("agents.list"):
+                agents = self.client.agents.list(name=self.chat_id)
+            return agents[0] if agents else self.set_agent()
+
+    def set_agent(self) -> "AgentState":
+        from letta_client import CreateBlock, EmbeddingConfig
 
-    def get_recent_text_context(self, max_chars=3500, max_messages=20) -> str:
-        messages = self.client.agents.messages.list(
-            agent_id=self.agent.id, limit=max_messages)
-        buffer = []
-        total_chars = 0
+        llm_config = self.model if self.model else self.get_models()
+        with letta_call("agents.create"):
+            return self.client.agents.create(
+                name=self.chat_id,
+                llm_config=llm_config,
+                embedding_config=EmbeddingConfig(
+                    embedding_endpoint_type="openai",
+                    embedding_model="text-embedding-3-small",
+                    embedding_dim=1024,
+                ),
+                memory_blocks=[
+                    CreateBlock(value="", label="human"),
+                    CreateBlock(value="", label="persona")
+                ],
+                enable_sleeptime=True
+            )
+
+    def get_recent_text_context(self, max_messages=20) -> str:
+        # served from the rolling buffer; the memory server is only read on a cold miss
+        if self.context.loaded:
+            return self.context.text()
+
+        with letta_call("messages.list"):
+            messages = self.client.agents.messages.list(
+                agent_id=self.agent.id, limit=max_messages)
 
         for msg in reversed(messages):  # Oldest to newest
             role = getattr(msg, "message_type", "")
@@ -83,45 +272,291 @@ class MemoryAgent:
             if content is None:
                 continue
 
-            labeled_text = f"{role.replace('_message', '').capitalize()}: {content}"
-            if total_chars + len(labeled_text) > max_chars:
-                break
+            self.context.append(role.replace('_message', '').capitalize(), content)
+        self.context.loaded = True
+        return self.context.text()
 
-            buffer.append(labeled_text)
-            total_chars += len(labeled_text)
-        return "\n".join(buffer)
+    def record_context(self, role: str, content: str):
+        # before the first cold load the server already has these messages
+        if self.context.loaded and content:
+            self.context.append(role, content)
 
     def send_message(self, whatsapp_msg):
-        content: list[Union[TextContent, ImageContent]] = []
-
-        if whatsapp_msg.has_media and whatsapp_msg.media.type in SUPPORTED_MEDIA_TYPES:
-            content.append(ImageContent(
-                source=Base64Image(
-                    type="base64",
-                    media_type=whatsapp_msg.media.type,
-                    data=whatsapp_msg.media.base64
-                )
-            ))
-        if whatsapp_msg.quoted:
-            if whatsapp_msg.quoted.type == "chat":
-                content.append(TextContent(
-                    text=f"{whatsapp_msg.message}\n\n(Quoted): {whatsapp_msg.quoted.body}"))
-            if whatsapp_msg.quoted.type == "image" and whatsapp_msg.quoted.mimetype in SUPPORTED_MEDIA_TYPES:
-                content.append(ImageContent(
-                    source=Base64Image(
-                        type="base64",
-                        media_type=whatsapp_msg.quoted.mimetype,
-                        data=whatsapp_msg.quoted.base64_data)
-                ))
-        else:
-            content.append(TextContent(text=f"{whatsapp_msg.message}"))
+        """Send a message, or a list of messages as one user turn, and return the reply."""
+        # make the buffered chatter searchable before the agent answers
+        self.flush()
+        message = self.user_message(whatsapp_msg)
+        with letta_call("messages.create"):
+            response = self.client.agents.messages.create(
+                agent_id=self.agent.id,
+                messages=[message]
+            )
+        return self._handle_response(whatsapp_msg, response)
 
-        response = self.client.agents.messages.create(
-            agent_id=self.agent.id,
-            messages=[MessageCreate(role="user", content=content)]
-        )
+    def stream_message(self, whatsapp_msg) -> Iterator[str]:
+        """Like ``send_message`` but yields the assistant reply as it is generated."""
+        self.flush()
+        message = self.user_message(whatsapp_msg)
+        # timed and guarded up to the first chunk only: between chunks the consumer is sending
+        # to WhatsApp, which is neither memory server latency nor a reason to hold the breaker
+        with letta_call("messages.create_stream"):
+            stream = iter(self.client.agents.messages.create_stream(
+                agent_id=self.agent.id,
+                messages=[message],
+                stream_tokens=REPLY_STREAM_TOKENS
+            ))
+            first = next(stream, None)
+        parts = []
+        for chunk in itertools.chain([first], stream) if first is not None else ():
+            delta = assistant_delta(chunk)
+            if delta:
+                parts.append(delta)
+                yield delta
+        self._record_exchange(whatsapp_msg, "".join(parts))
 
+    def _handle_response(self, whatsapp_msg, response) -> str:
         assistant_reply = next(
             m for m in response.messages if m.message_type == "assistant_message")
         # print(f"Assistant Reply: {assistant_reply.content}")
+        self._record_exchange(whatsapp_msg, assistant_reply.content)
         return assistant_reply.content
+
+    def _record_exchange(self, whatsapp_msg, reply: str):
+        for msg in as_batch(whatsapp_msg):
+            self.record_context("User", msg.message)
+        self.record_context("Assistant", reply)
+
+    def user_message(self, whatsapp_msg) -> "MessageCreate":
+        # a burst of messages becomes one turn with the content parts of each; a picture that is
+        # both attached and quoted, or sent twice in the burst, goes out once
+        seen = set()
+        content = [part for msg in as_batch(whatsapp_msg) for part in self.build_content(msg, seen)]
+        from letta_client import MessageCreate
+
+        return MessageCreate(role="user", content=content)
+
+    def build_content(self, whatsapp_msg, seen: Optional[set] = None) -> List[Union["TextContent", "ImageContent"]]:
+        """Content parts of one message: its images (downscaled when downloaded), then one text part."""
+        from letta_client import Base64Image, ImageContent, TextContent
+
+        seen = set() if seen is None else seen
+        images = []
+        # media is downloaded lazily, only once we know it is sent to the agent
+        if whatsapp_msg.has_media and whatsapp_msg.media.type in SUPPORTED_MEDIA_TYPES and whatsapp_msg.media.base64:
+            images.append((whatsapp_msg.media.type, whatsapp_msg.media.base64))
+        text = whatsapp_msg.message
+        quoted = whatsapp_msg.quoted
+        if quoted:
+            if quoted.type == "chat" and quoted.body:
+                text = f"{text}\n\n(Quoted): {quoted.body}"
+            if quoted.type == "image" and quoted.mimetype in SUPPORTED_MEDIA_TYPES and quoted.base64_data:
+                images.append((quoted.mimetype, quoted.base64_data))
+                if quoted.caption:
+                    text = f"{text}\n\n(Quoted image caption): {quoted.caption}"
+
+        content: List[Union[TextContent, ImageContent]] = []
+        for media_type, data in images:
+            # equal pictures share one cached string, so this is mostly an identity check
+            if data in seen:
+                continue
+            seen.add(data)
+            content.append(ImageContent(source=Base64Image(type="base64", media_type=media_type, data=data)))
+        content.append(TextContent(text=text))
+        return content
+
+
+class AsyncMemoryAgent(MemoryAgent):
+    """MemoryAgent whose agent calls run on the async Letta client.
+
+    Passage writes keep using the sync client, on the write-behind thread.
+    Media must be loaded (``await whatsapp_msg.load_media()``) before
+    ``send_message`` so building the content does no blocking I/O.
+    """
+
+    def __init__(self, recipient: str, agent: Optional["AgentState"] = None, session: str = "default"):
+        super().__init__(recipient, agent=agent, session=session)
+        self.aclient = get_async_letta_client()
+
+    async def aremember(self, text: str, role: str):
+        if PASSAGE_WRITE_BEHIND:
+            self.remember(text, role)
+        else:
+            await asyncio.to_thread(self.remember, text, role)
+
+    async def send_message(self, whatsapp_msg):
+        await asyncio.to_thread(self.flush)
+        message = self.user_message(whatsapp_msg)
+        with letta_call("messages.create"):
+            response = await self.aclient.agents.messages.create(
+                agent_id=self.agent.id,
+                messages=[message]
+            )
+        return self._handle_response(whatsapp_msg, response)
+
+    async def stream_message(self, whatsapp_msg) -> AsyncIterator[str]:
+        await asyncio.to_thread(self.flush)
+        message = self.user_message(whatsapp_msg)
+        with letta_call("messages.create_stream"):
+            stream = self.aclient.agents.messages.create_stream(
+                agent_id=self.agent.id,
+                messages=[message],
+                stream_tokens=REPLY_STREAM_TOKENS
+            ).__aiter__()
+            try:
+                chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+        parts = []
+        while chunk is not None:
+            delta = assistant_delta(chunk)
+            if delta:
+                parts.append(delta)
+                yield delta
+            try:
+                chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+        self._record_exchange(whatsapp_msg, "".join(parts))
+
+    async def get_recent_text_context(self, max_messages=20) -> str:
+        if self.context.loaded:
+            return self.context.text()
+        await asyncio.to_thread(super().get_recent_text_context, max_messages)
+        return self.context.text()
+
+
+class AgentRegistry:
+    """Bounded map of recipient -> MemoryAgent.
+
+    Agents idle for more than ``idle_ttl`` seconds, or beyond ``max_size``
+    (least recently used first), are dropped after flushing their buffered
+    passages. ``warm_up`` resolves every existing agent with one paginated
+    list call so the first message of a chat skips the per-agent lookup.
+    There is one registry per WAHA session; agents of sessions other than
+    "default" are named ``<session>__<chat id>`` so numbers never share one.
+    """
+
+    def __init__(self, max_size: int = 1000, idle_ttl: float = 3600.0, factory=MemoryAgent, session: str = "default"):
+        self.factory = factory
+        self.session = session
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._agents: "OrderedDict[str, tuple]" = OrderedDict()
+        self._known: Dict[str, "AgentState"] = {}
+        self._creating: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    def get(self, recipient: str) -> MemoryAgent:
+        agent = self.peek(recipient)
+        if agent is not None:
+            return agent
+        with self._lock:
+            create_lock = self._creating.setdefault(recipient, threading.Lock())
+
+        with create_lock:
+            with self._lock:
+                entry = self._agents.get(recipient)
+                if entry is not None:
+                    return entry[0]
+                known = self._known.pop(chat_id_for(recipient, self.session), None)
+            try:
+                agent = self.factory(recipient, agent=known, session=self.session)
+            except BaseException:
+                with self._lock:
+                    self._creating.pop(recipient, None)
+                raise
+            with self._lock:
+                # stored before the lock goes, so a caller arriving now finds it instead of creating another
+                self._agents[recipient] = (agent, time.monotonic())
+                self._creating.pop(recipient, None)
+                self.created += 1
+                evicted = self._collect_evictions()
+
+        for stale in evicted:
+            self._release(stale)
+        return agent
+
+    def peek(self, recipient: str) -> Optional[MemoryAgent]:
+        """Return the agent if it is already loaded, without creating it."""
+        with self._lock:
+            entry = self._agents.get(recipient)
+            if entry is not None:
+                self._agents[recipient] = (entry[0], time.monotonic())
+                self._agents.move_to_end(recipient)
+            # idle agents also go while no new chats arrive
+            evicted = self._collect_evictions()
+        self._release_later(evicted)
+        return entry[0] if entry is not None else None
+
+    def remember(self, recipient: str, text: str, role: str):
+        """Remember a line for a chat without loading its agent first.
+
+        With write-behind the agent is only resolved when the buffered lines
+        are written, off the request path.
+        """
+        agent = self.peek(recipient)
+        if agent is None and not PASSAGE_WRITE_BEHIND:
+            try:
+                agent = self.get(recipient)
+            except Exception as e:
+                logger.warning(f"Queueing passage for {recipient} until its agent can be loaded: {e}")
+        if agent is not None:
+            agent.remember(text, role)
+            return
+        if text:
+            _passage_buffer.add(chat_id_for(recipient, self.session), role, clip_passage(text),
+                                writer=durable_writer(self.session, recipient,
+                                                      lambda lines: self.get(recipient)._write_passages(lines)))
+
+    def _collect_evictions(self) -> List[MemoryAgent]:
+        evicted = []
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._agents:
+            recipient, (agent, last_used) = next(iter(self._agents.items()))
+            if len(self._agents) <= self.max_size and last_used >= cutoff:
+                break
+            del self._agents[recipient]
+            evicted.append(agent)
+        self.evicted += len(evicted)
+        return evicted
+
+    def _release_later(self, evicted: List[MemoryAgent]):
+        # flushing writes to the memory server, which peek's callers (the event loop among them) must not wait on
+        if evicted:
+            threading.Thread(target=lambda: [self._release(agent) for agent in evicted],
+                             name="agent-release", daemon=True).start()
+
+    def _release(self, agent: MemoryAgent):
+        try:
+            agent.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush passages for evicted agent {agent.chat_id}: {e}")
+        # lines that could not be written, or arrived since, stay buffered and are written later
+        _passage_buffer.discard(agent.chat_id)
+        logger.debug("Evicted idle MemoryAgent for %s", agent.chat_id)
+
+    def warm_up(self, agents: Optional[List["AgentState"]] = None):
+        """Seed the registry with existing agents; ``agents`` lets several registries share one listing."""
+        if agents is None:
+            agents = list_agents()
+        prefix = "" if self.session == "default" else f"{self.session}__"
+        known = {agent.name: agent for agent in agents
+                 if agent.name.startswith(prefix) and (prefix or "__" not in agent.name)}
+        with self._lock:
+            self._known.update(known)
+        logger.info(f"Warmed up {len(known)} memory agents for session {self.session}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            evicted = self._collect_evictions()
+            stats = {
+                "agents": len(self._agents),
+                "known": len(self._known),
+                "max_size": self.max_size,
+                "created": self.created,
+                "evicted": self.evicted,
+            }
+        self._release_later(evicted)
+        return stats
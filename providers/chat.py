@@ -0,0 +1,33 @@
+from typing import List
+
+from config import config
+from providers.dalle import get_async_client, get_client
+from providers.prompts import build_fallback_prompt
+from utiles import metrics
+from utiles.circuit_breaker import get_breaker
+
+# model for answers without memory, used while the memory server is unavailable; "off" disables them
+FALLBACK_MODEL = config.get("fallback_model", "gpt-4.1-mini")
+
+
+def enabled() -> bool:
+    return FALLBACK_MODEL.lower() != "off"
+
+
+def _messages(texts: List[str], context: str) -> list:
+    return [{"role": "system", "content": build_fallback_prompt(context)},
+            {"role": "user", "content": "\n\n".join(texts)}]
+
+
+def reply(texts: List[str], context: str = "") -> str:
+    """Stateless answer to ``texts``, given the recent chat ``context``."""
+    with get_breaker("openai").guard(), metrics.downstream("openai", "chat.completions.create"):
+        response = get_client().chat.completions.create(model=FALLBACK_MODEL, messages=_messages(texts, context))
+    return response.choices[0].message.content or ""
+
+
+async def areply(texts: List[str], context: str = "") -> str:
+    with get_breaker("openai").guard(), metrics.downstream("openai", "chat.completions.create"):
+        response = await get_async_client().chat.completions.create(model=FALLBACK_MODEL,
+                                                                    messages=_messages(texts, context))
+    return response.choices[0].message.content or ""
@@ -1,21 +1,101 @@
+import hashlib
+import threading
+from typing import TYPE_CHECKING, Optional
+
 from config import config
-from openai import OpenAI
+from utiles import metrics
+from utiles.cache import TTLCache
+from utiles.circuit_breaker import get_breaker
 from utiles.logger import Logger
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
 logger = Logger(__name__)
 
+_client: Optional["OpenAI"] = None
+_async_client: Optional["AsyncOpenAI"] = None
+_client_lock = threading.Lock()
+# the SDK waits up to 10 minutes by default
+OPENAI_TIMEOUT = config.get("openai_timeout", 60.0, float)
+# generated image URLs expire after an hour, keep results a bit less than that
+_results = TTLCache(maxsize=config.get("dalle_cache_size", 256, int),
+                    ttl=config.get("dalle_cache_ttl", 3000, float), name="dalle")
+
+
+def get_client() -> "OpenAI":
+    """The OpenAI client shared by image generation and fallback answers; the SDK is imported on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+
+                _client = OpenAI(api_key=config.openai_api_key, timeout=OPENAI_TIMEOUT)
+    return _client
+
+
+def get_async_client() -> "AsyncOpenAI":
+    global _async_client
+    if _async_client is None:
+        from openai import AsyncOpenAI
+
+        _async_client = AsyncOpenAI(api_key=config.openai_api_key, timeout=OPENAI_TIMEOUT)
+    return _async_client
+
+
+def prompt_key(prompt: str, context: str) -> str:
+    """Cache key of a request: case and whitespace differences don't make a new image."""
+    normalized = [" ".join(text.casefold().split()) for text in (prompt, context)]
+    return hashlib.sha256("\n".join(normalized).encode("utf-8")).hexdigest()
+
+
+def cache_stats() -> dict:
+    return _results.stats()
+
+
 class Dalle:
     def __init__(self):
         self.model = config.dalle_model
-        self.client = OpenAI(api_key=config.openai_api_key)
         self.context = ""
         self.prompt = ""
-        
+
+    def cache_key(self) -> str:
+        return prompt_key(self.prompt, self.context)
+
+    def cached(self) -> Optional[str]:
+        """URL of an image already generated for this prompt and context, if any."""
+        return _results.get(self.cache_key())
+
     def request(self):
-        logger.info(f"Sending prompt to OpenAI DALL-E with context: {self.context} and prompt: {self.prompt}")
-        response = self.client.images.generate(
-            model=self.model,
-            prompt=f"some erlier context: {self.context}, my request: {self.prompt}"
-        )
+        # identical requests running at the same time share one generation
+        return _results.get_or_load(self.cache_key(), self._generate)
+
+    def _generate(self):
+        logger.info("Sending prompt to OpenAI DALL-E with context: %s and prompt: %s", self.context, self.prompt)
+        with get_breaker("openai").guard(), metrics.downstream("openai", "images.generate"):
+            response = get_client().images.generate(
+                model=self.model,
+                prompt=f"some erlier context: {self.context}, my request: {self.prompt}"
+            )
         image_url = response.data[0].url
-        return image_url
\ No newline at end of file
+        return image_url
+
+
+class AsyncDalle(Dalle):
+    def __init__(self):
+        self.model = config.dalle_model
+        self.context = ""
+        self.prompt = ""
+
+    async def request(self):
+        return await _results.async_get_or_load(self.cache_key(), self._agenerate)
+
+    async def _agenerate(self):
+        logger.info("Sending prompt to OpenAI DALL-E with context: %s and prompt: %s", self.context, self.prompt)
+        with get_breaker("openai").guard(), metrics.downstream("openai", "images.generate"):
+            response = await get_async_client().images.generate(
+                model=self.model,
+                prompt=f"some erlier context: {self.context}, my request: {self.prompt}"
+            )
+        return response.data[0].url
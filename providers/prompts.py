@@ -28,4 +28,13 @@ def build_system_prompt() -> str:
         - If the user shares a preference, respond like a trusted companion would — acknowledge it, maybe ask a light follow-up, but don’t overreact
 
         You’re here to help — whether that’s managing tasks, remembering facts, or just chatting. Stay friendly, relevant, and human.
-    """
\ No newline at end of file
+    """
+
+def build_fallback_prompt(context: str = "") -> str:
+    prompt = f"""
+        You are a helpful personal assistant chatting on WhatsApp.
+        Today's date is **{datetime.now().strftime("%B %d, %Y")}**.
+        Your long-term memory is unavailable right now, so answer from the recent conversation below only,
+        briefly, and without pretending to remember more than it shows.
+    """
+    return f"{prompt}\n        Recent conversation:\n{context}" if context else prompt
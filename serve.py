@@ -0,0 +1,81 @@
+"""Run the bot as several worker processes on one machine, one per core by default.
+
+Worker 0 listens on --port, which is where WAHA's webhook points; worker i
+listens on --port + i. Every worker knows all of them (SHARD_PEERS) and its
+own position (SHARD_INDEX), and passes webhooks of chats that hash to
+another worker on to it, so each chat's memory agent, context and message
+order stay in one process. A load balancer may spread webhooks over all
+the ports instead of sending them to worker 0.
+
+    python serve.py --workers 4
+    python serve.py --server flask --port 5002
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def worker_command(kind: str, host: str, port: int) -> List[str]:
+    # both run under uvicorn rather than a development server; the Flask app through its WSGI interface
+    if kind == "asgi":
+        return [sys.executable, "-m", "uvicorn", "asgi_app:app", "--host", host, "--port", str(port)]
+    return [sys.executable, "-m", "uvicorn", "app:app", "--interface", "wsgi", "--host", host, "--port", str(port)]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--server", choices=("asgi", "flask"), default="asgi")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5002)
+    args = parser.parse_args(argv)
+
+    ports = [args.port + index for index in range(args.workers)]
+    env = dict(os.environ, SHARD_PEERS=",".join(f"http://127.0.0.1:{port}" for port in ports))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    # contact and group lookups and the agent creation locks are shared through a file, unless .env says otherwise
+    env.setdefault("CACHE_BACKEND", "sqlite")
+
+    workers: Dict[int, subprocess.Popen] = {}
+    stopping = False
+
+    def start(index: int):
+        workers[index] = subprocess.Popen(worker_command(args.server, args.host, ports[index]),
+                                          env=dict(env, SHARD_INDEX=str(index)))
+        print(f"worker {index} (pid {workers[index].pid}) listening on port {ports[index]}", flush=True)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(args.workers):
+        start(index)
+
+    while not stopping:
+        time.sleep(1)
+        for index, process in list(workers.items()):
+            if process.poll() is not None and not stopping:
+                # its chats have nowhere else to go, so bring it back on the same port
+                print(f"worker {index} exited with {process.returncode}, restarting", flush=True)
+                start(index)
+
+    for process in workers.values():
+        if process.poll() is None:
+            process.terminate()
+    for process in workers.values():
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class _Inflight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire ``ttl`` seconds after being stored.
+
+    ``get_or_load`` coalesces concurrent misses for the same key: the first
+    caller runs the loader, the others wait for its result. With a shared
+    ``backend`` a miss is looked up there before loading, so worker
+    processes share what one of them loaded.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600.0, name: str = "cache", backend=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.backend = backend if backend is not None and backend.shared else None
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, _Inflight] = {}
+        self._async_inflight: Dict[Hashable, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key: Hashable):
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def _store(self, key: Hashable, value: Any, ttl: Optional[float]):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def peek(self, key: Hashable, default=None):
+        """Like ``get`` but without touching LRU order or counters."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                return default
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._store(key, value, ttl)
+        if self.backend is not None:
+            self.backend.set(self._shared_key(key), value, self.ttl if ttl is None else ttl)
+
+    def _shared_key(self, key: Hashable) -> str:
+        return f"{self.name}:{key}"
+
+    def _load(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float]):
+        if self.backend is None:
+            return loader()
+        value = self.backend.get(self._shared_key(key))
+        if value is None:
+            value = loader()
+            self.backend.set(self._shared_key(key), value, self.ttl if ttl is None else ttl)
+        return value
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float] = None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+            inflight = self._inflight.get(key)
+            owner = inflight is None
+            if owner:
+                inflight = self._inflight[key] = _Inflight()
+
+        if not owner:
+            inflight.event.wait()
+            if inflight.error is not None:
+                raise inflight.error
+            return inflight.value
+
+        try:
+            inflight.value = self._load(key, loader, ttl)
+        except BaseException as e:
+            inflight.error = e
+            raise
+        else:
+            with self._lock:
+                # an invalidation while loading means the result may already be stale
+                if self._inflight.get(key) is inflight:
+                    self._store(key, inflight.value, ttl)
+            return inflight.value
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is inflight:
+                    del self._inflight[key]
+            inflight.event.set()
+
+    async def async_get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], ttl: Optional[float] = None):
+        """``get_or_load`` for coroutine loaders; concurrent misses on one event loop share one load."""
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+            future = self._async_inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._async_inflight[key] = asyncio.get_running_loop().create_future()
+
+        if not owner:
+            return await asyncio.shield(future)
+
+        try:
+            # a shared backend is a local file, quick enough to read on the event loop
+            value = self.backend.get(self._shared_key(key)) if self.backend is not None else None
+            if value is None:
+                value = await loader()
+                if self.backend is not None:
+                    self.backend.set(self._shared_key(key), value, self.ttl if ttl is None else ttl)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # mark the exception retrieved so waiter-less failures are not logged by asyncio
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            with self._lock:
+                if self._async_inflight.get(key) is future:
+                    self._store(key, value, ttl)
+            return value
+        finally:
+            with self._lock:
+                if self._async_inflight.get(key) is future:
+                    del self._async_inflight[key]
+
+    def invalidate(self, key: Hashable) -> bool:
+        if self.backend is not None:
+            self.backend.delete(self._shared_key(key))
+        with self._lock:
+            self._inflight.pop(key, None)
+            self._async_inflight.pop(key, None)
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._inflight.clear()
+            self._async_inflight.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.peek(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,210 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from config import config
+from utiles.logger import Logger
+
+logger = Logger(__name__)
+
+
+class CacheBackend:
+    """Where caches and locks shared by the worker processes live.
+
+    This in-process backend shares nothing: the ``TTLCache`` in front of it
+    already is the process's cache, so ``get`` always misses, and ``lock``
+    only serializes the threads of this process. ``SQLiteCacheBackend``
+    shares values and locks between processes on one machine.
+    """
+    shared = False
+
+    def __init__(self):
+        self._locks: Dict[str, threading.Lock] = {}
+        self._users: Dict[str, int] = {}
+        self._locks_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        return None
+
+    def set(self, key: str, value: Any, ttl: float):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = 60.0) -> Iterator[None]:
+        """Hold the lock ``name``, e.g. while creating one chat's memory agent."""
+        with self._locks_lock:
+            local = self._locks.setdefault(name, threading.Lock())
+            self._users[name] = self._users.get(name, 0) + 1
+        try:
+            with local:
+                self._acquire_shared(name, timeout)
+                try:
+                    yield
+                finally:
+                    self._release_shared(name)
+        finally:
+            with self._locks_lock:
+                self._users[name] -= 1
+                if not self._users[name]:
+                    del self._users[name]
+                    del self._locks[name]
+
+    def _acquire_shared(self, name: str, timeout: float):
+        pass
+
+    def _release_shared(self, name: str):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "locks": len(self._locks)}
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """CacheBackend in a SQLite file every worker process on the machine opens.
+
+    Values are pickled; the file is only written by the bot itself. A lock
+    is a row with an expiry, so one left behind by a crashed process is
+    taken over after ``lease`` seconds.
+    """
+    shared = True
+
+    def __init__(self, path: str, lease: float = 120.0, poll_interval: float = 0.05, prune_every: int = 1000):
+        super().__init__()
+        self.path = path
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.prune_every = prune_every
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                         "expires_at REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, "
+                         "expires_at REAL NOT NULL)")
+        self._db_lock = threading.Lock()
+        self._owner = f"{os.getpid()}-{id(self)}"
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        # one connection for the process; sqlite3 connections must not be used by two threads at once
+        with self._db_lock:
+            return self._db.execute(sql, params)
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            row = self._execute("SELECT value FROM entries WHERE key = ? AND expires_at > ?",
+                                (key, time.time())).fetchone()
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.error(f"Cache {self.path} unavailable: {e}")
+            return None
+        if row is not None:
+            try:
+                value = pickle.loads(row[0])
+            except Exception as e:
+                # written by a process running other code (a __main__ module, an older release)
+                logger.debug("Ignoring unreadable cache entry %s: %s", key, e)
+            else:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning(f"Not sharing {key}, it can't be pickled: {e}")
+            return
+        try:
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                self._execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+            self._execute("INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+                          (key, data, now + ttl))
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.error(f"Failed to store {key} in {self.path}: {e}")
+
+    def delete(self, key: str):
+        try:
+            self._execute("DELETE FROM entries WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.error(f"Failed to delete {key} from {self.path}: {e}")
+
+    def _acquire_shared(self, name: str, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.time()
+            try:
+                # an expired lease from a crashed process can be taken over
+                cursor = self._execute(
+                    "INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                    "WHERE expires_at < ?",
+                    (name, self._owner, now + self.lease, now))
+                if cursor.rowcount == 1:
+                    return
+            except sqlite3.Error as e:
+                # better a rare duplicate than a chat that can't be answered
+                self.errors += 1
+                logger.error(f"Lock {name} in {self.path} unavailable, going ahead without it: {e}")
+                return
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Lock {name} is still held by another process after {timeout:.0f}s")
+            time.sleep(self.poll_interval)
+
+    def _release_shared(self, name: str):
+        try:
+            self._execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, self._owner))
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.error(f"Failed to release lock {name} in {self.path}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "locks": len(self._locks),
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+def create_backend(backend: str, path: str = ".cache.sqlite3") -> CacheBackend:
+    backend = backend.lower()
+    if backend == "sqlite":
+        return SQLiteCacheBackend(path, lease=config.get("cache_lock_lease", 120.0, float))
+    if backend != "memory":
+        logger.warning(f"Unknown cache backend '{backend}', using memory")
+    return CacheBackend()
+
+
+_backend: Optional[CacheBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> CacheBackend:
+    """The process-wide backend chosen by CACHE_BACKEND."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend(config.get("cache_backend", "memory"),
+                                          path=config.get("cache_path", ".cache.sqlite3"))
+    return _backend
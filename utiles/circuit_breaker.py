@@ -0,0 +1,158 @@
+import threading
+import time
+from typing import Dict, Optional
+
+from config import config
+from utiles.logger import Logger
+
+logger = Logger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} is unavailable, retrying in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class LocalError(Exception):
+    """Raised by our own checks on what a service returned, e.g. a size cap; it says nothing about the service."""
+
+
+def is_failure(e: BaseException) -> bool:
+    """Whether an exception says the service is in trouble; a 4xx answer other than 429 means it is up."""
+    if isinstance(e, LocalError):
+        return False
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return not (isinstance(status, int) and 400 <= status < 500 and status != 429)
+
+
+class CircuitBreaker:
+    """Stops calling a dependency after ``failure_threshold`` failures in a row.
+
+    While open, calls fail at once with ``CircuitOpenError`` so callers can
+    fall back instead of waiting for timeouts. After ``recovery_timeout``
+    seconds up to ``half_open_calls`` trial calls go through: a success
+    closes the circuit again, a failure opens it for another period.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0,
+                 half_open_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+
+    def guard(self) -> "_Guard":
+        """``with breaker.guard(): call()`` runs one call through the breaker."""
+        return _Guard(self)
+
+    def retry_in(self) -> float:
+        return max(0.0, self._opened_at + self.recovery_timeout - time.monotonic())
+
+    def is_open(self) -> bool:
+        return self.state == OPEN and self.retry_in() > 0
+
+    def _acquire(self) -> bool:
+        """Let a call through, returning whether it is a half-open probe."""
+        with self._lock:
+            if self.state == OPEN:
+                if self.retry_in() > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self.retry_in())
+                self.state = HALF_OPEN
+                self._probes = 0
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, 0)
+                self._probes += 1
+                return True
+            return False
+
+    def _release(self, probe: bool, failed: Optional[bool]):
+        with self._lock:
+            if probe:
+                self._probes -= 1
+            if failed is None:
+                # cancelled, says nothing about the service
+                return
+            if not failed:
+                if self.state == HALF_OPEN:
+                    logger.info(f"{self.name} recovered, closing circuit")
+                self.state = CLOSED
+                self._failures = 0
+                return
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                logger.warning(f"{self.name} failed {self._failures} times, opening circuit "
+                               f"for {self.recovery_timeout:.0f}s")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": OPEN if self.is_open() else (HALF_OPEN if self.state != CLOSED else CLOSED),
+                "failures": self._failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+
+class _Guard:
+    __slots__ = ("breaker", "probe")
+
+    def __init__(self, breaker: CircuitBreaker):
+        self.breaker = breaker
+
+    def __enter__(self):
+        self.probe = self.breaker._acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            failed = False
+        elif issubclass(exc_type, Exception):
+            failed = is_failure(exc)
+        else:
+            failed = None
+        self.breaker._release(self.probe, failed)
+        return False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """The process-wide breaker of a dependency ("waha", "letta", "openai")."""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(
+                    name,
+                    failure_threshold=config.get("circuit_failure_threshold", 5, int),
+                    recovery_timeout=config.get("circuit_recovery_timeout", 30.0, float),
+                    half_open_calls=config.get("circuit_half_open_calls", 1, int))
+    return breaker
+
+
+def breaker_stats() -> dict:
+    return {name: breaker.stats() for name, breaker in list(_breakers.items())}
@@ -0,0 +1,60 @@
+import threading
+from collections import deque
+from typing import Optional
+
+
+def estimate_tokens(text: str) -> int:
+    # rough 4-chars-per-token estimate, good enough for budgeting a prompt
+    return len(text) // 4 + 1
+
+
+class ContextBuffer:
+    """Rolling window of labelled lines bounded by a char and optional token budget.
+
+    Appending evicts the oldest lines until the window fits again; the joined
+    text is cached until the next change.
+    """
+
+    def __init__(self, max_chars: int = 3500, max_tokens: Optional[int] = None):
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        self.loaded = False
+        self._lines = deque()
+        self._chars = 0
+        self._tokens = 0
+        self._text: Optional[str] = ""
+        self._lock = threading.Lock()
+
+    def _over_budget(self) -> bool:
+        # +1 per line for the joining newline
+        if self._chars + len(self._lines) - 1 > self.max_chars:
+            return True
+        return self.max_tokens is not None and self._tokens > self.max_tokens
+
+    def append(self, label: str, content: str):
+        line = f"{label}: {content}"
+        with self._lock:
+            self._lines.append(line)
+            self._chars += len(line)
+            self._tokens += estimate_tokens(line)
+            while self._lines and self._over_budget():
+                evicted = self._lines.popleft()
+                self._chars -= len(evicted)
+                self._tokens -= estimate_tokens(evicted)
+            self._text = None
+
+    def text(self) -> str:
+        with self._lock:
+            if self._text is None:
+                self._text = "\n".join(self._lines)
+            return self._text
+
+    def clear(self):
+        with self._lock:
+            self._lines.clear()
+            self._chars = self._tokens = 0
+            self._text = ""
+            self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._lines)
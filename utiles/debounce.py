@@ -0,0 +1,123 @@
+import threading
+import time
+from typing import Callable, Dict, Hashable, List
+
+from utiles.logger import Logger
+
+logger = Logger(__name__)
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []
+        self.first_at = 0.0
+        self.last_at = 0.0
+
+
+class Debouncer:
+    """Collects items per key and releases them together to ``on_ready``.
+
+    A key's batch is released once no item arrived for ``window`` seconds,
+    and at most ``max_wait`` seconds after its first item, but never while
+    the key's previous batch is still being handled: items arriving then
+    wait for the next batch. Whoever handles a batch must call ``done``.
+    """
+
+    def __init__(self, window: float, on_ready: Callable[[Hashable, List], None], max_wait: float = 10.0,
+                 name: str = "debounce"):
+        self.window = window
+        self.max_wait = max(max_wait, window)
+        self.on_ready = on_ready
+        self.name = name
+        self._batches: Dict[Hashable, _Batch] = {}
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self.added = 0
+        self.released = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def add(self, key: Hashable, item):
+        self.start()
+        now = time.monotonic()
+        with self._cond:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = _Batch()
+                batch.first_at = now
+            batch.items.append(item)
+            batch.last_at = now
+            self.added += 1
+            self._cond.notify()
+
+    def done(self, key: Hashable):
+        with self._cond:
+            self._busy.discard(key)
+            self._cond.notify()
+
+    def _deadline(self, batch: _Batch) -> float:
+        return min(batch.last_at + self.window, batch.first_at + self.max_wait)
+
+    def _take_due(self, now: float, force: bool = False):
+        due = []
+        wait = None
+        for key, batch in list(self._batches.items()):
+            if key in self._busy and not force:
+                continue
+            delay = self._deadline(batch) - now
+            if delay <= 0 or force:
+                del self._batches[key]
+                self._busy.add(key)
+                due.append((key, batch.items))
+            else:
+                wait = delay if wait is None else min(wait, delay)
+        return due, wait
+
+    def _release(self, due):
+        for key, items in due:
+            self.released += 1
+            try:
+                self.on_ready(key, items)
+            except Exception as e:
+                logger.error(f"Failed to hand over {len(items)} debounced items for {key}: {e}")
+                self.done(key)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                due, wait = self._take_due(time.monotonic())
+                if not due:
+                    self._cond.wait(timeout=wait if wait is not None else 1.0)
+                    continue
+            self._release(due)
+
+    def stop(self):
+        """Release everything still waiting, so it is handled before the workers shut down."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            due, _ = self._take_due(time.monotonic(), force=True)
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+        self._release(due)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "window": self.window,
+                "pending": sum(len(batch.items) for batch in self._batches.values()),
+                "chats": len(self._batches),
+                "in_flight": len(self._busy),
+                "added": self.added,
+                "released": self.released,
+            }
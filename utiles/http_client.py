@@ -0,0 +1,187 @@
+import asyncio
+import random
+import threading
+from typing import TYPE_CHECKING, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError
+from urllib3.util.retry import Retry
+
+from config import config
+from utiles.circuit_breaker import CircuitOpenError, LocalError
+from utiles.logger import Logger
+
+if TYPE_CHECKING:
+    # only the async server talks to WAHA through httpx
+    import httpx
+
+logger = Logger(__name__)
+
+POOL_SIZE = config.get("waha_pool_size", 20, int)
+CONNECT_TIMEOUT = config.get("waha_connect_timeout", 3.05, float)
+READ_TIMEOUT = config.get("waha_read_timeout", 30.0, float)
+RETRIES = config.get("waha_retries", 3, int)
+BACKOFF = config.get("waha_backoff", 0.5, float)
+BACKOFF_JITTER = config.get("waha_backoff_jitter", 0.5, float)
+
+MEDIA_MAX_BYTES = config.get("media_max_bytes", 10 * 1024 * 1024, int)
+MEDIA_CHUNK_SIZE = config.get("media_chunk_size", 64 * 1024, int)
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# statuses where WAHA did not act on the request, so even a POST is safe to resend
+REJECTED_STATUSES = frozenset({429, 503})
+
+_session: Optional[requests.Session] = None
+_async_session: Optional["httpx.AsyncClient"] = None
+_lock = threading.Lock()
+
+
+class DownloadTooLargeError(LocalError):
+    pass
+
+
+class WahaRetry(Retry):
+    """urllib3 retry policy that also resends POSTs the server rejected outright."""
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == "POST" and status_code in REJECTED_STATUSES:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def retryable(method: str, e: Exception) -> bool:
+    """Whether a failed request may be sent again.
+
+    A POST only when WAHA provably did not act on it: the breaker refused
+    it, the connection was never made, or WAHA rejected it with 429/503. A
+    read timeout or a connection dropped mid-request may follow a delivered
+    message, which sending again would duplicate.
+    """
+    if isinstance(e, CircuitOpenError):
+        return True
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if method.upper() != "POST":
+        return status is None or status in RETRY_STATUSES or status >= 500
+    if status is not None:
+        return status in REJECTED_STATUSES
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    return isinstance(e, requests.ConnectionError) and not isinstance(e.args[0] if e.args else None, ProtocolError)
+
+
+def _headers() -> dict:
+    return {"X-Api-Key": config.waha_api_key}
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                retry = WahaRetry(
+                    total=RETRIES,
+                    connect=RETRIES,
+                    read=RETRIES,
+                    status=RETRIES,
+                    backoff_factor=BACKOFF,
+                    backoff_jitter=BACKOFF_JITTER,
+                    status_forcelist=RETRY_STATUSES,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                                      max_retries=retry, pool_block=True)
+                session = requests.Session()
+                session.headers.update(_headers())
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+                logger.debug(f"Created WAHA session (pool {POOL_SIZE}, retries {RETRIES})")
+    return _session
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().request(method.upper(), url, **kwargs)
+
+
+def download(url: str, max_bytes: int = MEDIA_MAX_BYTES, chunk_size: int = MEDIA_CHUNK_SIZE) -> bytes:
+    """Stream ``url`` into memory, giving up as soon as it exceeds ``max_bytes``."""
+    with get_session().get(url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+        response.raise_for_status()
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise DownloadTooLargeError(f"{url} is {length} bytes, limit is {max_bytes}")
+        buffer = bytearray()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            buffer.extend(chunk)
+            if len(buffer) > max_bytes:
+                raise DownloadTooLargeError(f"{url} exceeds {max_bytes} bytes")
+        return bytes(buffer)
+
+
+def get_async_session() -> "httpx.AsyncClient":
+    # httpx clients are bound to the event loop they are first used on,
+    # so this is meant to be called from the single ASGI loop
+    global _async_session
+    if _async_session is None or _async_session.is_closed:
+        import httpx
+
+        _async_session = httpx.AsyncClient(
+            headers=_headers(),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+            transport=httpx.AsyncHTTPTransport(retries=RETRIES),
+        )
+    return _async_session
+
+
+def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return BACKOFF * (2 ** attempt) + random.uniform(0, BACKOFF_JITTER)
+
+
+async def async_request(method: str, url: str, **kwargs) -> "httpx.Response":
+    method = method.upper()
+    client = get_async_session()
+    attempt = 0
+    while True:
+        response = await client.request(method, url, **kwargs)
+        retryable = RETRY_STATUSES if method != "POST" else REJECTED_STATUSES
+        if response.status_code not in retryable or attempt >= RETRIES:
+            return response
+        delay = _backoff(attempt, response.headers.get("Retry-After"))
+        logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.2f}s")
+        await response.aclose()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def async_download(url: str, max_bytes: int = MEDIA_MAX_BYTES, chunk_size: int = MEDIA_CHUNK_SIZE) -> bytes:
+    async with get_async_session().stream("GET", url) as response:
+        response.raise_for_status()
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise DownloadTooLargeError(f"{url} is {length} bytes, limit is {max_bytes}")
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes(chunk_size):
+            buffer.extend(chunk)
+            if len(buffer) > max_bytes:
+                raise DownloadTooLargeError(f"{url} exceeds {max_bytes} bytes")
+        return bytes(buffer)
+
+
+def close_session():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+async def close_async_session():
+    global _async_session
+    if _async_session is not None:
+        await _async_session.aclose()
+        _async_session = None
@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from utiles.logger import Logger
+
+logger = Logger(__name__)
+
+
+class IdempotencyStore:
+    """Remembers which keys (webhook message ids) have already been claimed.
+
+    ``claim`` returns True only for the first caller of a key within ``ttl``
+    seconds; ``release`` forgets a key again so a retry of a message that
+    could not be handled is processed. The in-memory window holds the last
+    ``max_size`` keys of this process.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 86400.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.claimed = 0
+        self.duplicates = 0
+
+    def _seen_locally(self, key: str, now: float) -> bool:
+        seen_at = self._seen.get(key)
+        return seen_at is not None and now - seen_at < self.ttl
+
+    def _remember(self, key: str, now: float):
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+
+    def _claim_shared(self, key: str, now: float) -> bool:
+        return True
+
+    def claim(self, key: str) -> bool:
+        now = time.time()
+        with self._lock:
+            if self._seen_locally(key, now) or not self._claim_shared(key, now):
+                self.duplicates += 1
+                return False
+            # only keys claimed here are kept, a release by another process must stay visible
+            self._remember(key, now)
+            self.claimed += 1
+            return True
+
+    def release(self, key: str):
+        with self._lock:
+            self._seen.pop(key, None)
+            self._release_shared(key)
+
+    def _release_shared(self, key: str):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "window": len(self._seen),
+            "claimed": self.claimed,
+            "duplicates": self.duplicates,
+        }
+
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """IdempotencyStore shared between processes through a SQLite file.
+
+    The in-memory window still answers repeats claimed by this process;
+    other keys are claimed with a single insert, which only one process
+    can win.
+    """
+
+    def __init__(self, path: str, max_size: int = 10000, ttl: float = 86400.0, prune_every: int = 1000):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.path = path
+        self.prune_every = prune_every
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, claimed_at REAL NOT NULL)")
+        self._inserts = 0
+
+    def _claim_shared(self, key: str, now: float) -> bool:
+        try:
+            self._inserts += 1
+            if self._inserts % self.prune_every == 0:
+                self._db.execute("DELETE FROM claims WHERE claimed_at < ?", (now - self.ttl,))
+            # an expired row from an earlier claim can be taken over
+            cursor = self._db.execute(
+                "INSERT INTO claims (key, claimed_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET claimed_at = excluded.claimed_at WHERE claimed_at < ?",
+                (key, now, now - self.ttl))
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            # the local window still catches most duplicates, don't drop messages over it
+            logger.error(f"Idempotency store {self.path} unavailable: {e}")
+            return True
+
+    def _release_shared(self, key: str):
+        try:
+            self._db.execute("DELETE FROM claims WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.error(f"Failed to release {key} in {self.path}: {e}")
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["backend"] = "sqlite"
+        return stats
+
+
+def create_store(backend: str, path: str = ".dedup.sqlite3", max_size: int = 10000,
+                 ttl: float = 86400.0) -> Optional[IdempotencyStore]:
+    backend = backend.lower()
+    if backend in ("off", "none", ""):
+        return None
+    if backend == "sqlite":
+        return SQLiteIdempotencyStore(path, max_size=max_size, ttl=ttl)
+    if backend != "memory":
+        logger.warning(f"Unknown dedup backend '{backend}', using memory")
+    return IdempotencyStore(max_size=max_size, ttl=ttl)
+
+
+def message_key(payload: dict, session: str = "default") -> Optional[str]:
+    """Idempotency key of a webhook message payload, None if it has no id.
+
+    Keys are scoped by session: two of our numbers in the same group both
+    receive a message under the same id, and each has to handle it.
+    """
+    message_id = payload.get("id")
+    if isinstance(message_id, dict):
+        message_id = message_id.get("_serialized")
+    return f"{session}:{message_id}" if message_id else None
@@ -0,0 +1,46 @@
+import io
+
+from config import config
+from utiles.logger import Logger
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow comes with qrcode[pil]; without it images are sent as received
+    Image = ImageOps = None
+
+logger = Logger(__name__)
+
+# longest side, in pixels, of images sent to the agent; 0 sends them as received
+IMAGE_MAX_SIDE = config.get("image_max_side", 1024, int)
+IMAGE_QUALITY = config.get("image_quality", 80, int)
+
+
+def prepare_image(data: bytes, mimetype: str, max_side: int = IMAGE_MAX_SIDE, quality: int = IMAGE_QUALITY) -> bytes:
+    """Image downscaled to ``max_side`` and re-encoded, in its original format.
+
+    A phone photo of several megabytes becomes a JPEG of a few hundred
+    kilobytes at most. The original is returned when it can't be decoded or
+    when re-encoding would not make it smaller.
+    """
+    if Image is None or max_side <= 0:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # JPEGs are decoded at the smallest 1/2^n scale still above the target, which is much faster
+            image.draft("RGB", (max_side, max_side))
+            image = ImageOps.exif_transpose(image)
+            resized = max(image.size) > max_side
+            if resized:
+                image.thumbnail((max_side, max_side), Image.LANCZOS)
+            out = io.BytesIO()
+            if mimetype == "image/png":
+                image.save(out, "PNG", optimize=True)
+            else:
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                image.save(out, "JPEG", quality=quality, optimize=True)
+    except Exception as e:
+        logger.warning(f"Sending image as received, it could not be prepared: {e}")
+        return data
+    prepared = out.getvalue()
+    return prepared if resized or len(prepared) < len(data) else data
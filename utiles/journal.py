@@ -0,0 +1,228 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import config
+from utiles.circuit_breaker import CircuitOpenError, is_failure
+from utiles.logger import Logger
+
+logger = Logger(__name__)
+
+
+class Journal:
+    """Append-only log of work that must survive a restart, in a SQLite file in WAL mode.
+
+    Entries get increasing sequence numbers. A reader keeps its position as
+    a named checkpoint; ``checkpoint`` also deletes every entry up to it,
+    so the file only holds what is still to be done.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # an append survives a crash of the process; only a power loss can take the last ones
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "kind TEXT NOT NULL, data TEXT NOT NULL, created_at REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[], None]] = []
+        self.appended = 0
+
+    def append(self, kind: str, data: dict) -> int:
+        with self._lock:
+            cursor = self._db.execute("INSERT INTO entries (kind, data, created_at) VALUES (?, ?, ?)",
+                                      (kind, json.dumps(data, ensure_ascii=False), time.time()))
+            self.appended += 1
+        for listener in self._listeners:
+            listener()
+        return cursor.lastrowid
+
+    def on_append(self, listener: Callable[[], None]):
+        self._listeners.append(listener)
+
+    def read(self, after: int, limit: int) -> List[Tuple[int, str, dict]]:
+        with self._lock:
+            rows = self._db.execute("SELECT seq, kind, data FROM entries WHERE seq > ? ORDER BY seq LIMIT ?",
+                                    (after, limit)).fetchall()
+        return [(seq, kind, json.loads(data)) for seq, kind, data in rows]
+
+    def position(self, name: str) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT seq FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def checkpoint(self, name: str, seq: int):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("INSERT INTO checkpoints (name, seq) VALUES (?, ?) "
+                                 "ON CONFLICT(name) DO UPDATE SET seq = excluded.seq", (name, seq))
+                self._db.execute("DELETE FROM entries WHERE seq <= ?", (seq,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def compact(self):
+        """Fold the WAL file back into the database and truncate it, once there is nothing left to replay."""
+        with self._lock:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JournalDrainer:
+    """Replays journal entries in order on a background thread.
+
+    Each entry is passed to the handler registered for its kind, at most
+    ``batch_size`` per read, and the checkpoint moves past every entry that
+    was handled. An entry that fails because its service is unavailable
+    stops the drain, so nothing overtakes it, and is retried after a
+    backoff of up to ``max_backoff`` seconds. One the service refused
+    outright (a 4xx other than 429) is logged and skipped. A kind can bring
+    its own ``retryable`` check to decide that instead. Entries are
+    handled at least once: a crash before the checkpoint replays them.
+    """
+
+    def __init__(self, journal: Journal, batch_size: int = 50, backoff: float = 1.0, max_backoff: float = 60.0,
+                 name: str = "journal"):
+        self.journal = journal
+        self.batch_size = batch_size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.name = name
+        self._handlers: Dict[str, Tuple[Callable[[dict], None], Callable[[Exception], bool]]] = {}
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self.replayed = 0
+        self.skipped = 0
+        self.retries = 0
+        journal.on_append(self._wake.set)
+
+    def register(self, kind: str, handler: Callable[[dict], None],
+                 retryable: Callable[[Exception], bool] = is_failure):
+        self._handlers[kind] = (handler, retryable)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-drainer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def _run(self):
+        position = self.journal.position(self.name)
+        while not self._stopping.is_set():
+            # cleared before reading, so an append during the drain is not missed
+            self._wake.clear()
+            try:
+                position, delay = self._drain(position)
+            except sqlite3.Error as e:
+                logger.error(f"Journal {self.journal.path} unavailable: {e}")
+                delay = self.max_backoff
+            self._wake.wait(timeout=delay)
+
+    def _drain(self, position: int) -> Tuple[int, Optional[float]]:
+        """Handle entries after ``position``; returns the new position and how long to wait before trying again."""
+        drained = False
+        while not self._stopping.is_set():
+            entries = self.journal.read(position, self.batch_size)
+            if not entries:
+                if drained:
+                    self.journal.compact()
+                return position, None
+            drained = True
+            handled = current = position
+            try:
+                for current, kind, data in entries:
+                    if self._stopping.is_set():
+                        break
+                    self._handle(current, kind, data)
+                    handled = current
+            except Exception as e:
+                self._failures += 1
+                self.retries += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (self._failures - 1))
+                if isinstance(e, CircuitOpenError):
+                    delay = max(delay, e.retry_in)
+                logger.warning(f"Replaying journal entry {current} failed ({e}), retrying in {delay:.0f}s")
+                return self._advance(position, handled), delay
+            self._failures = 0
+            position = self._advance(position, handled)
+        return position, None
+
+    def _handle(self, seq: int, kind: str, data: dict):
+        if kind not in self._handlers:
+            logger.error(f"No handler for journal entry {seq} of kind {kind}, skipping it")
+            self.skipped += 1
+            return
+        handler, retryable = self._handlers[kind]
+        try:
+            handler(data)
+        except Exception as e:
+            if retryable(e):
+                raise
+            logger.error(f"Journal entry {seq} ({kind}) will not be retried, skipping it: {e}")
+            self.skipped += 1
+            return
+        self.replayed += 1
+
+    def _advance(self, position: int, handled: int) -> int:
+        if handled > position:
+            self.journal.checkpoint(self.name, handled)
+        return handled
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.journal.depth(),
+            "appended": self.journal.appended,
+            "replayed": self.replayed,
+            "skipped": self.skipped,
+            "retries": self.retries,
+        }
+
+
+_journal: Optional[Journal] = None
+_journal_lock = threading.Lock()
+
+
+def journal_path(path: str, index: Optional[int]) -> str:
+    """Each sharded worker keeps its own journal, next to the others."""
+    if index is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index}{ext}"
+
+
+def get_journal() -> Optional[Journal]:
+    """The process-wide journal, None when JOURNAL is off (or none, false)."""
+    global _journal
+    if _journal is None and config.get("journal", "sqlite").lower() not in ("off", "none", "false"):
+        with _journal_lock:
+            if _journal is None:
+                index = config.get("shard_index", None, int) if config.get("shard_peers") else None
+                _journal = Journal(journal_path(config.get("journal_path", ".journal.sqlite3"), index))
+    return _journal
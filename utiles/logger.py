@@ -1,42 +1,100 @@
+import atexit
+import json
 import logging
-import inspect
+import logging.handlers
+import queue
+from typing import Optional
+
 from config import config
 
+# "text" keeps the human readable lines, "json" writes one JSON object per record
+LOG_FORMAT = config.get("log_format", "text").lower()
+# format and write records on a background thread instead of in the request
+LOG_QUEUE = config.get("log_queue", True, bool)
+
+_handler: Optional[logging.Handler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": record.filename,
+            "func": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _formatter() -> logging.Formatter:
+    if LOG_FORMAT == "json":
+        return JsonFormatter(datefmt="%Y-%m-%dT%H:%M:%S%z")
+    return logging.Formatter(
+        fmt="%(asctime)s | %(levelname)s | file: %(filename)s | func: %(funcName)s | %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+
+def _shared_handler() -> logging.Handler:
+    """One handler for every Logger; with LOG_QUEUE it only enqueues and a listener thread does the writing."""
+    global _handler, _listener
+    if _handler is None:
+        stream = logging.StreamHandler()
+        stream.setFormatter(_formatter())
+        if LOG_QUEUE:
+            records = queue.SimpleQueue()
+            _listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+            _listener.start()
+            # registered on first use, so it runs after everything else has logged its shutdown
+            atexit.register(_listener.stop)
+            _handler = logging.handlers.QueueHandler(records)
+        else:
+            _handler = stream
+    return _handler
+
+
 class Logger:
+    """Thin wrapper around a ``logging.Logger``.
+
+    Messages take %-style arguments that are only formatted when the level
+    is enabled (``logger.debug("Contact %s: %s", sender, contact)``), and
+    the caller's file and function come from the record itself.
+    """
+
     def __init__(self, name: str = "WAHALogger"):
         self.logger = logging.getLogger(name)
-        self.logger.setLevel(config.log_level)
+        self.logger.setLevel(config.get("log_level", "INFO").upper())
         self.logger.propagate = False
 
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter(
-            fmt="%(asctime)s | %(levelname)s | %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S"
-        )
-        handler.setFormatter(formatter)
-
         if not self.logger.handlers:
-            self.logger.addHandler(handler)
+            self.logger.addHandler(_shared_handler())
 
-    def _log(self, level: str, message: str):
-        # Get caller function name and filename (2 frames up)
-        frame = inspect.currentframe().f_back.f_back
-        caller = frame.f_code.co_name
-        filename = frame.f_code.co_filename.split("/")[-1]
-        formatted = f"file: {filename} | func: {caller} | {message}"
-        getattr(self.logger, level)(formatted)
+    def is_enabled(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
 
-    def debug(self, message: str):
-        self._log("debug", message)
+    # stacklevel=2 attributes the record to our caller rather than to these wrappers
+    def debug(self, message: str, *args):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(message, *args, stacklevel=2)
 
-    def info(self, message: str):
-        self._log("info", message)
+    def info(self, message: str, *args):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(message, *args, stacklevel=2)
 
-    def warning(self, message: str):
-        self._log("warning", message)
+    def warning(self, message: str, *args):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning(message, *args, stacklevel=2)
 
-    def error(self, message: str):
-        self._log("error", message)
+    def error(self, message: str, *args):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(message, *args, stacklevel=2)
 
-    def critical(self, message: str):
-        self._log("critical", message)
+    def critical(self, message: str, *args):
+        if self.logger.isEnabledFor(logging.CRITICAL):
+            self.logger.critical(message, *args, stacklevel=2)
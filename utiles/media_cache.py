@@ -0,0 +1,199 @@
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from utiles.logger import Logger
+
+logger = Logger(__name__)
+
+
+class MediaCache:
+    """Two-level cache for downloaded media.
+
+    Files are content addressed: each distinct payload is stored once under
+    its sha256 digest, in the base64 form the agent is sent
+    (``<digest>.b64``). Message/stanza ids map to digests, so the same image
+    forwarded or quoted under different ids is encoded once; the mapping is
+    kept on disk as well (``<hash of id>.key`` holding the digest), so a
+    restarted process finds media it fetched before. The base64 form of
+    recently used files is kept in a byte-bounded in-memory LRU; the disk
+    directory is bounded too and trimmed oldest-first.
+
+    ``put`` can ``prepare`` the payload first (downscale an image); only
+    the prepared form is stored, and the digest of the original maps to it
+    so the same download under another id is not prepared again.
+    """
+
+    def __init__(self, directory: Optional[str] = ".media_cache", max_memory_bytes: int = 64 * 1024 * 1024,
+                 max_disk_bytes: int = 512 * 1024 * 1024, max_keys: int = 10000):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._keys: "OrderedDict[str, str]" = OrderedDict()
+        self._prepared: "OrderedDict[str, str]" = OrderedDict()
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.received_bytes = 0
+        self.prepared_bytes = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _path(self, digest: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{digest}.{suffix}")
+
+    def _link_path(self, name: str, suffix: str) -> str:
+        # ids and URLs are not safe file names
+        return self._path(hashlib.sha256(name.encode("utf-8")).hexdigest(), suffix)
+
+    def _remember(self, index: "OrderedDict[str, str]", name: str, digest: str, suffix: str, persist: bool = True):
+        if persist and index.get(name) != digest and self.directory:
+            try:
+                self._write_file(self._link_path(name, suffix), digest.encode("ascii"))
+            except OSError as e:
+                logger.warning(f"Could not write media index entry to disk cache: {e}")
+        index[name] = digest
+        index.move_to_end(name)
+        while len(index) > self.max_keys:
+            index.popitem(last=False)
+
+    def _lookup(self, index: "OrderedDict[str, str]", name: str, suffix: str) -> Optional[str]:
+        digest = index.get(name)
+        if digest is None and self.directory:
+            data = self._read_file(self._link_path(name, suffix))
+            if data:
+                digest = data.decode("ascii")
+                self._remember(index, name, digest, suffix, persist=False)
+        return digest
+
+    def _remember_key(self, key: str, digest: str):
+        self._remember(self._keys, key, digest, "key")
+
+    def _remember_memory(self, digest: str, encoded: str):
+        if digest in self._memory:
+            self._memory.move_to_end(digest)
+            return
+        self._memory[digest] = encoded
+        self._memory_bytes += len(encoded)
+        while self._memory_bytes > self.max_memory_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _read_file(self, path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_file(self, path: str, data: bytes):
+        # per process, so two workers storing the same file don't write into one temp file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        self._disk_bytes += len(data)
+
+    def _trim_disk(self):
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.is_file()),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._disk_bytes -= size
+
+    def _load_base64(self, digest: str) -> Optional[str]:
+        encoded = self._memory.get(digest)
+        if encoded is not None:
+            self._memory.move_to_end(digest)
+            return encoded
+        if not self.directory:
+            return None
+        data = self._read_file(self._path(digest, "b64"))
+        if data is None:
+            return None
+        encoded = data.decode("ascii")
+        self._remember_memory(digest, encoded)
+        return encoded
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached base64 payload stored under ``key``, if any."""
+        with self._lock:
+            digest = self._lookup(self._keys, key, "key")
+            encoded = self._load_base64(digest) if digest else None
+            if encoded is None:
+                self.misses += 1
+                return None
+            self._keys.move_to_end(key)
+            self.hits += 1
+            return encoded
+
+    def put(self, key: str, data: bytes, prepare: Optional[Callable[[bytes], bytes]] = None) -> str:
+        """Store ``data`` (after ``prepare``) under ``key`` and return its base64 form.
+
+        A previous encode, or preparation, of the same content is reused.
+        """
+        if prepare is not None:
+            source = self.digest(data)
+            with self._lock:
+                digest = self._lookup(self._prepared, source, "src")
+                encoded = self._load_base64(digest) if digest else None
+                if encoded is not None:
+                    self._prepared.move_to_end(source)
+                    self._remember_key(key, digest)
+                    return encoded
+            # outside the lock, decoding and resizing a photo takes tens of milliseconds
+            received = len(data)
+            data = prepare(data)
+            digest = self.digest(data)
+            with self._lock:
+                self.received_bytes += received
+                self.prepared_bytes += len(data)
+                self._remember(self._prepared, source, digest, "src")
+        else:
+            digest = self.digest(data)
+        with self._lock:
+            encoded = self._load_base64(digest)
+            if encoded is None:
+                encoded = base64.b64encode(data).decode("ascii")
+                self._remember_memory(digest, encoded)
+                if self.directory:
+                    try:
+                        self._write_file(self._path(digest, "b64"), encoded.encode("ascii"))
+                        self._trim_disk()
+                    except OSError as e:
+                        logger.warning(f"Could not write media {digest} to disk cache: {e}")
+            self._remember_key(key, digest)
+            return encoded
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "keys": len(self._keys),
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "received_bytes": self.received_bytes,
+                "prepared_bytes": self.prepared_bytes,
+            }
@@ -0,0 +1,155 @@
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# from a cached lookup (sub-millisecond) to an agent or image generation (tens of seconds)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# a family is (name, type, help, [(labels, value), ...])
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{_format_labels(dict(zip(self.labels, label_values)))} {_format_value(value)}")
+        return lines
+
+
+class _Series:
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self, size: int):
+        self.buckets = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; ``observe`` is a bisect and three additions under a lock."""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.bounds = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], _Series] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # the last slot counts values above the highest bound
+                series = self._series[label_values] = _Series(len(self.bounds) + 1)
+            series.buckets[index] += 1
+            series.sum += value
+            series.count += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(label_values, list(series.buckets), series.sum, series.count)
+                        for label_values, series in self._series.items()]
+        for label_values, buckets, total, count in snapshot:
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, observed in zip(self.bounds + (float("inf"),), buckets):
+                cumulative += observed
+                bucket_labels = _format_labels(dict(labels, le=_format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Timer:
+    """Context manager timing a block into a histogram; a block that raises also counts as an error."""
+    __slots__ = ("histogram", "errors", "label_values", "started")
+
+    def __init__(self, histogram: Histogram, errors: Counter, label_values: Tuple[str, ...]):
+        self.histogram = histogram
+        self.errors = errors
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            self.errors.inc(*self.label_values)
+        return False
+
+
+STAGE_SECONDS = Histogram("whatsapp_stage_duration_seconds",
+                          "Time spent in each stage of handling a message.", ("stage",))
+STAGE_ERRORS = Counter("whatsapp_stage_errors_total", "Stages that ended with an exception.", ("stage",))
+DOWNSTREAM_SECONDS = Histogram("whatsapp_downstream_duration_seconds",
+                               "Duration of calls to WAHA, Letta and OpenAI.", ("service", "operation"))
+DOWNSTREAM_ERRORS = Counter("whatsapp_downstream_errors_total",
+                            "Calls to WAHA, Letta and OpenAI that failed.", ("service", "operation"))
+WEBHOOKS = Counter("whatsapp_webhooks_total", "Webhooks received, by outcome.", ("status",))
+
+_metrics = [STAGE_SECONDS, STAGE_ERRORS, DOWNSTREAM_SECONDS, DOWNSTREAM_ERRORS, WEBHOOKS]
+
+
+def stage(name: str) -> Timer:
+    """``with stage("agent_call"): ...`` times one processing stage."""
+    return Timer(STAGE_SECONDS, STAGE_ERRORS, (name,))
+
+
+def downstream(service: str, operation: str) -> Timer:
+    """``with downstream("letta", "messages.create"): ...`` times one call to another service."""
+    return Timer(DOWNSTREAM_SECONDS, DOWNSTREAM_ERRORS, (service, operation))
+
+
+def render(families: Iterable[Family] = ()) -> str:
+    """Prometheus text exposition of the built-in metrics plus ``families``.
+
+    Values that are already tracked elsewhere (queue depths, cache hits)
+    are passed in as families at scrape time instead of being counted twice.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, kind, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,68 @@
+import re
+import time
+from typing import Optional
+
+# a sentence ends at . ! ? or … (optionally followed by closing quotes/brackets) and whitespace, or at a blank line
+_SENTENCE_END = re.compile(r"(?:[.!?…]+[\"')\]]*\s+|\n\s*\n)")
+
+
+class SentenceChunker:
+    """Turns a stream of text deltas into sentence-sized chunks.
+
+    ``feed`` returns the chunk that is ready to be sent, if any: complete
+    sentences adding up to at least ``min_chars``, released no sooner than
+    ``min_interval`` seconds after the previous chunk. Text held back by the
+    interval is merged into the next chunk. ``finish`` returns whatever is
+    left once the stream ends.
+    """
+
+    def __init__(self, min_chars: int = 40, max_chars: int = 1500, min_interval: float = 1.0):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.min_interval = min_interval
+        self.text = ""
+        self._buffer = ""
+        self._last_sent = 0.0
+
+    def feed(self, delta: str) -> Optional[str]:
+        if not delta:
+            return None
+        self.text += delta
+        self._buffer += delta
+        if time.monotonic() - self._last_sent < self.min_interval:
+            return None
+
+        cut = self._cut()
+        if cut < self.min_chars:
+            return None
+        chunk, self._buffer = self._buffer[:cut], self._buffer[cut:]
+        return self._emit(chunk)
+
+    def _cut(self) -> int:
+        cut = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            cut = match.end()
+        if not cut and len(self._buffer) >= self.max_chars:
+            # no sentence boundary in sight, break at the last space instead
+            cut = self._buffer.rfind(" ", 0, self.max_chars) + 1 or self.max_chars
+        return cut
+
+    def _emit(self, chunk: str) -> Optional[str]:
+        chunk = chunk.strip()
+        if not chunk:
+            return None
+        self._last_sent = time.monotonic()
+        return chunk
+
+    @property
+    def released(self) -> str:
+        """All text handed out as chunks so far, formatting preserved."""
+        return self.text[:len(self.text) - len(self._buffer)].strip()
+
+    def wait_time(self) -> float:
+        """Seconds left before the next chunk may be sent."""
+        return max(0.0, self._last_sent + self.min_interval - time.monotonic())
+
+    def finish(self) -> Optional[str]:
+        chunk, self._buffer = self._buffer, ""
+        return self._emit(chunk)
@@ -0,0 +1,328 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from utiles.http_client import retryable
+from utiles.logger import Logger
+from utiles.worker_pool import QueueFullError
+
+logger = Logger(__name__)
+
+INTERACTIVE = 0
+BULK = 1
+
+COALESCE_ENDPOINT = "/api/sendText"
+# WhatsApp accepts much longer texts, but merged replies beyond this read badly
+COALESCE_MAX_CHARS = 4096
+
+
+class TokenBucket:
+    """``rate`` tokens per second, at most ``burst`` saved up; a rate <= 0 never limits."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Send:
+    __slots__ = ("session", "chat_id", "method", "endpoint", "payload", "priority", "seq",
+                 "futures", "enqueued_at", "not_before", "attempts", "durable")
+
+    def __init__(self, session, chat_id, method, endpoint, payload, priority, seq, durable=True):
+        self.session = session
+        self.chat_id = chat_id
+        self.method = method
+        self.endpoint = endpoint
+        self.payload = payload
+        self.priority = priority
+        self.seq = seq
+        self.futures: List[Future] = [Future()]
+        self.enqueued_at = time.monotonic()
+        self.not_before = 0.0
+        self.attempts = 0
+        self.durable = durable
+
+
+class SendScheduler:
+    """Paces outbound WAHA sends with token buckets per chat and per session.
+
+    Sends to one chat go out one at a time and in order. Across chats, the
+    highest priority head whose buckets allow it goes first (``INTERACTIVE``
+    before ``BULK``, then FIFO). A text queued behind another unsent text to
+    the same chat within ``coalesce_window`` seconds is merged into it.
+    Failed sends are retried with exponential backoff when
+    ``http_client.retryable`` allows it, so a POST WAHA may have acted on is
+    never sent twice. ``send`` returns a Future with the response.
+
+    A durable send that still fails after its retries, or is still queued
+    when the scheduler stops, is handed to ``spill`` (to be kept and sent
+    later); if that accepts it, its Future resolves to None.
+    """
+
+    def __init__(self, sender: Callable, chat_rate: float = 1.0, chat_burst: float = 3,
+                 session_rate: float = 10.0, session_burst: float = 20, workers: int = 4,
+                 max_retries: int = 3, backoff: float = 1.0, coalesce_window: float = 2.0,
+                 max_pending: int = 10000, name: str = "outbound",
+                 observe_wait: Optional[Callable[[float], None]] = None,
+                 spill: Optional[Callable[[str, str, str, str, dict], bool]] = None):
+        self.sender = sender
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.coalesce_window = coalesce_window
+        self.max_pending = max_pending
+        self.name = name
+        # called with the queueing delay of every send as it is dispatched
+        self.observe_wait = observe_wait
+        # called with (session, chat_id, method, endpoint, payload), returns whether it kept the send
+        self.spill = spill
+        self._cond = threading.Condition()
+        self._chats: Dict[Tuple[str, str], Deque[_Send]] = {}
+        self._busy = set()
+        self._chat_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._session_buckets: Dict[str, TokenBucket] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread = None
+        self._running = False
+        self._seq = 0
+        self._depth = 0
+        self._latencies: Deque[float] = deque(maxlen=1000)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.spilled = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"{self.name}-send")
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # give queued sends a chance to go out before shutting down
+            while (self._depth or self._busy) and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._running = False
+            leftover = [item for queue in self._chats.values() for item in queue]
+            self._chats.clear()
+            self._depth = 0
+            self._cond.notify_all()
+        for item in leftover:
+            if not self._spill(item):
+                self._resolve(item, error=RuntimeError(f"{self.name} scheduler stopped"))
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def send(self, session: str, chat_id: str, endpoint: str, payload: dict,
+             priority: int = INTERACTIVE, method: str = "POST", durable: bool = True) -> Future:
+        self.start()
+        key = (session, chat_id)
+        with self._cond:
+            queue = self._chats.get(key)
+            tail = queue[-1] if queue else None
+            if tail is not None and self._can_coalesce(tail, method, endpoint, payload, priority, durable):
+                tail.payload = dict(tail.payload, text=f"{tail.payload['text']}\n\n{payload['text']}")
+                tail.futures.append(Future())
+                self.coalesced += 1
+                return tail.futures[-1]
+
+            if self._depth >= self.max_pending:
+                self.rejected += 1
+                raise QueueFullError(f"{self.name} queue is full ({self._depth} pending)")
+            self._seq += 1
+            item = _Send(session, chat_id, method, endpoint, payload, priority, self._seq, durable)
+            if queue is None:
+                queue = self._chats[key] = deque()
+            queue.append(item)
+            self._depth += 1
+            self._cond.notify()
+            return item.futures[0]
+
+    def _can_coalesce(self, tail: _Send, method: str, endpoint: str, payload: dict, priority: int,
+                      durable: bool) -> bool:
+        return (endpoint == COALESCE_ENDPOINT and tail.endpoint == COALESCE_ENDPOINT
+                and method == tail.method and priority == tail.priority and durable == tail.durable
+                and not tail.attempts
+                and time.monotonic() - tail.enqueued_at <= self.coalesce_window
+                and len(tail.payload.get("text", "")) + len(payload.get("text", "")) <= COALESCE_MAX_CHARS)
+
+    def _bucket(self, buckets: dict, key, rate: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def _next_ready(self, now: float):
+        """Pick the send to dispatch now, or return how long to wait for one."""
+        best = None
+        wait = None
+        for key, queue in self._chats.items():
+            if key in self._busy:
+                continue
+            item = queue[0]
+            chat_bucket = self._bucket(self._chat_buckets, key, self.chat_rate, self.chat_burst)
+            session_bucket = self._bucket(self._session_buckets, item.session, self.session_rate, self.session_burst)
+            delay = max(item.not_before - now, chat_bucket.delay(now), session_bucket.delay(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or (item.priority, item.seq) < (best.priority, best.seq):
+                best = item
+        return best, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                item, wait = self._next_ready(now)
+                if item is None:
+                    self._cond.wait(timeout=min(wait, 1.0) if wait is not None else 1.0)
+                    continue
+                key = (item.session, item.chat_id)
+                self._chat_buckets[key].consume(now)
+                self._session_buckets[item.session].consume(now)
+                queue = self._chats[key]
+                queue.popleft()
+                if not queue:
+                    del self._chats[key]
+                self._depth -= 1
+                self._busy.add(key)
+                waited = None if item.attempts else now - item.enqueued_at
+                if waited is not None:
+                    self._latencies.append(waited)
+                self._prune_buckets(now)
+            if waited is not None and self.observe_wait is not None:
+                self.observe_wait(waited)
+            self._executor.submit(self._execute, item)
+
+    def _prune_buckets(self, now: float):
+        # a full bucket holds no state worth keeping
+        if len(self._chat_buckets) > 4 * self.max_pending:
+            for key in [key for key, bucket in self._chat_buckets.items()
+                        if key not in self._chats and key not in self._busy and bucket.full(now)]:
+                del self._chat_buckets[key]
+
+    def _execute(self, item: _Send):
+        key = (item.session, item.chat_id)
+        try:
+            response = self.sender(item.method, item.endpoint, item.payload)
+        except Exception as e:
+            if item.attempts < self.max_retries and retryable(item.method, e):
+                item.attempts += 1
+                delay = self.backoff * (2 ** (item.attempts - 1)) + random.uniform(0, self.backoff)
+                logger.warning(f"Send to {item.chat_id} failed ({e}), retry {item.attempts} in {delay:.1f}s")
+                item.not_before = time.monotonic() + delay
+                with self._cond:
+                    self.retried += 1
+                    self._busy.discard(key)
+                    if self._running:
+                        # back at the head of its chat so later sends don't overtake it
+                        self._chats.setdefault(key, deque()).appendleft(item)
+                        self._depth += 1
+                        self._cond.notify_all()
+                        return
+                if not self._spill(item):
+                    self._resolve(item, error=e)
+                return
+            logger.error(f"Send to {item.chat_id} failed after {item.attempts + 1} attempts: {e}")
+            with self._cond:
+                self.failed += 1
+            if not (retryable(item.method, e) and self._spill(item)):
+                self._resolve(item, error=e)
+        else:
+            with self._cond:
+                self.sent += 1
+            self._resolve(item, response=response)
+        with self._cond:
+            self._busy.discard(key)
+            self._cond.notify_all()
+
+    def _spill(self, item: _Send) -> bool:
+        if not item.durable or self.spill is None:
+            return False
+        try:
+            kept = self.spill(item.session, item.chat_id, item.method, item.endpoint, item.payload)
+        except Exception as e:
+            logger.error(f"Could not keep failed send to {item.chat_id} for later: {e}")
+            return False
+        if kept:
+            with self._cond:
+                self.spilled += 1
+            self._resolve(item)
+        return kept
+
+    @staticmethod
+    def _resolve(item: _Send, response=None, error: Optional[Exception] = None):
+        for future in item.futures:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(response)
+
+    def depth(self) -> int:
+        return self._depth
+
+    def stats(self) -> dict:
+        with self._cond:
+            latencies = sorted(self._latencies)
+            return {
+                "depth": self._depth,
+                "in_flight": len(self._busy),
+                "chats": len(self._chats),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "spilled": self.spilled,
+                "queue_latency_p50": _percentile(latencies, 0.50),
+                "queue_latency_p95": _percentile(latencies, 0.95),
+                "queue_latency_max": latencies[-1] if latencies else 0.0,
+            }
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
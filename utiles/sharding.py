@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import threading
+from bisect import bisect
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import config
+from utiles.logger import Logger
+
+if TYPE_CHECKING:
+    import httpx
+
+logger = Logger(__name__)
+
+# set on webhooks passed on by another worker, which must handle them rather than pass them on again
+FORWARDED_HEADER = "X-Shard-Forwarded"
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring over ``nodes`` with ``replicas`` virtual points each.
+
+    Adding or removing a node only moves the keys of the ring segments it
+    gains or loses, about 1/N of them.
+    """
+
+    def __init__(self, nodes: List[str], replicas: int = 128):
+        points = sorted((_hash(f"{node}#{replica}"), node) for node in nodes for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: str) -> str:
+        index = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class ShardRouter:
+    """Sends every chat to one worker process, so its agent, context and queue live in one place.
+
+    ``peers`` are the base URLs of all workers, the same list in the same
+    order in each of them, and ``index`` is this worker's position in it.
+    A webhook for a chat another worker owns is forwarded to that worker.
+    """
+
+    def __init__(self, peers: List[str], index: int, replicas: int = 128, timeout: float = 10.0,
+                 pool_size: int = 20):
+        if not 0 <= index < len(peers):
+            raise ValueError(f"Shard index {index} is outside the {len(peers)} peers")
+        self.peers = [peer.rstrip("/") for peer in peers]
+        self.index = index
+        self.timeout = timeout
+        self.pool_size = pool_size
+        # ring nodes are positions, not URLs, so moving a worker to another port keeps its chats
+        self._ring = HashRing([str(position) for position in range(len(peers))], replicas)
+        self._session: Optional[requests.Session] = None
+        self._async_session: Optional["httpx.AsyncClient"] = None
+        self._lock = threading.Lock()
+        self.forwarded = 0
+        self.failed = 0
+
+    def owner(self, key: str) -> int:
+        return int(self._ring.node_for(key))
+
+    def is_local(self, key: str) -> bool:
+        return self.owner(key) == self.index
+
+    def _get_session(self) -> requests.Session:
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    adapter = HTTPAdapter(pool_connections=len(self.peers), pool_maxsize=self.pool_size)
+                    session = requests.Session()
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    def forward(self, owner: int, body: bytes, path: str = "/webhook") -> Tuple[int, bytes, dict]:
+        """Pass a webhook on to ``owner`` and return its (status, body, headers)."""
+        try:
+            response = self._get_session().post(
+                f"{self.peers[owner]}{path}", data=body, timeout=self.timeout,
+                headers={"Content-Type": "application/json", FORWARDED_HEADER: str(self.index)})
+        except requests.RequestException:
+            self.failed += 1
+            raise
+        self.forwarded += 1
+        return response.status_code, response.content, _passed_headers(response.headers)
+
+    async def aforward(self, owner: int, body: bytes, path: str = "/webhook") -> Tuple[int, bytes, dict]:
+        import httpx
+
+        # like the async WAHA session, this belongs to the one ASGI event loop
+        if self._async_session is None or self._async_session.is_closed:
+            self._async_session = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size))
+        try:
+            response = await self._async_session.post(
+                f"{self.peers[owner]}{path}", content=body,
+                headers={"Content-Type": "application/json", FORWARDED_HEADER: str(self.index)})
+        except httpx.HTTPError:
+            self.failed += 1
+            raise
+        self.forwarded += 1
+        return response.status_code, response.content, _passed_headers(response.headers)
+
+    def broadcast(self, body: bytes, path: str = "/webhook"):
+        """Pass a webhook on to every other worker, for events each of them has to see."""
+        for position in self._others():
+            try:
+                self.forward(position, body, path)
+            except requests.RequestException as e:
+                logger.warning(f"Worker {position} missed a broadcast webhook: {e}")
+
+    async def abroadcast(self, body: bytes, path: str = "/webhook"):
+        import httpx
+
+        async def send(position: int):
+            try:
+                await self.aforward(position, body, path)
+            except httpx.HTTPError as e:
+                logger.warning(f"Worker {position} missed a broadcast webhook: {e}")
+
+        await asyncio.gather(*(send(position) for position in self._others()))
+
+    def _others(self) -> List[int]:
+        return [position for position in range(len(self.peers)) if position != self.index]
+
+    async def aclose(self):
+        if self._async_session is not None:
+            await self._async_session.aclose()
+            self._async_session = None
+
+    def stats(self) -> dict:
+        return {
+            "index": self.index,
+            "peers": len(self.peers),
+            "forwarded": self.forwarded,
+            "failed": self.failed,
+        }
+
+
+def _passed_headers(headers) -> dict:
+    return {name: headers[name] for name in ("Content-Type", "Retry-After") if name in headers}
+
+
+def create_router() -> Optional[ShardRouter]:
+    """The router described by SHARD_PEERS and SHARD_INDEX, None when this is the only worker."""
+    peers = [peer.strip() for peer in config.get("shard_peers", "").split(",") if peer.strip()]
+    if len(peers) < 2:
+        return None
+    router = ShardRouter(peers, config.get("shard_index", 0, int),
+                         timeout=config.get("shard_forward_timeout", 10.0, float))
+    logger.info(f"Worker {router.index} of {len(peers)}, chats of other workers are forwarded")
+    return router
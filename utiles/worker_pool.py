@@ -0,0 +1,212 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from queue import Queue, Empty
+from typing import Awaitable, Callable, Dict, Hashable
+
+from utiles.logger import Logger
+
+logger = Logger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class KeyedWorkerPool:
+    """Runs tasks on a fixed pool of threads, serially per key.
+
+    Tasks sharing a key (a chat id) run one at a time in submission order,
+    tasks for different keys run in parallel up to ``workers`` at once.
+    ``max_pending`` bounds the total backlog; ``submit`` raises
+    ``QueueFullError`` instead of blocking when it is reached.
+    """
+
+    def __init__(self, workers: int = 4, max_pending: int = 1000, name: str = "worker"):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.name = name
+        self._lock = threading.Lock()
+        self._pending: Dict[Hashable, deque] = {}
+        self._ready: Queue = Queue()
+        self._idle = threading.Condition(self._lock)
+        self._depth = 0
+        self._active = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info(f"Started {self.workers} {self.name} threads (max pending {self.max_pending})")
+
+    def stop(self, timeout: float = 10.0):
+        """Run every task already submitted, for up to ``timeout`` seconds, then stop the threads."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            if not self._running:
+                return
+            # the workers requeue a chat's next task behind the current one, so a sentinel
+            # queued now would stop them before those tasks ran
+            while self._depth and time.monotonic() < deadline:
+                self._idle.wait(deadline - time.monotonic())
+            if self._depth:
+                logger.warning(f"Stopping {self.name} threads with {self._depth} tasks unfinished")
+            self._running = False
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    def submit(self, key: Hashable, func: Callable, *args, **kwargs):
+        with self._lock:
+            if self._depth >= self.max_pending:
+                self._rejected += 1
+                raise QueueFullError(f"{self.name} queue is full ({self._depth} pending)")
+            self._depth += 1
+            tasks = self._pending.get(key)
+            if tasks is None:
+                # no task for this key is queued or running, so it can be scheduled now
+                self._pending[key] = deque([(func, args, kwargs)])
+                self._ready.put(key)
+            else:
+                tasks.append((func, args, kwargs))
+
+    def _run(self):
+        while True:
+            try:
+                key = self._ready.get(timeout=1.0)
+            except Empty:
+                if not self._running:
+                    return
+                continue
+            if key is None:
+                return
+
+            with self._lock:
+                func, args, kwargs = self._pending[key][0]
+                self._active += 1
+
+            try:
+                func(*args, **kwargs)
+                failed = False
+            except Exception as e:
+                logger.error(f"Task for {key} failed: {e}")
+                failed = True
+
+            with self._lock:
+                self._active -= 1
+                self._depth -= 1
+                self._processed += 1
+                self._failed += failed
+                tasks = self._pending[key]
+                tasks.popleft()
+                if tasks:
+                    # requeue at the back so one busy chat cannot monopolise a worker
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+                if not self._depth:
+                    self._idle.notify_all()
+
+    def depth(self) -> int:
+        return self._depth
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "depth": self._depth,
+                "active": self._active,
+                "chats": len(self._pending),
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "max_pending": self.max_pending,
+            }
+
+
+class AsyncKeyedRunner:
+    """asyncio counterpart of ``KeyedWorkerPool``.
+
+    Each submitted coroutine runs as a task that first takes its key's lock
+    (asyncio locks wake waiters in FIFO order, so per-key order is kept) and
+    then one of ``concurrency`` semaphore slots.
+    """
+
+    def __init__(self, concurrency: int = 64, max_pending: int = 1000, name: str = "async-worker"):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.name = name
+        self._semaphore: asyncio.Semaphore = None
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._waiting: Dict[Hashable, int] = {}
+        self._tasks = set()
+        self._depth = 0
+        self._active = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def submit(self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs):
+        if self._depth >= self.max_pending:
+            self._rejected += 1
+            raise QueueFullError(f"{self.name} queue is full ({self._depth} pending)")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._depth += 1
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        task = asyncio.get_running_loop().create_task(self._run(key, lock, func, args, kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, lock, func, args, kwargs):
+        try:
+            async with lock:
+                async with self._semaphore:
+                    self._active += 1
+                    try:
+                        await func(*args, **kwargs)
+                    except Exception as e:
+                        logger.error(f"Task for {key} failed: {e}")
+                        self._failed += 1
+                    finally:
+                        self._active -= 1
+                        self._processed += 1
+        finally:
+            self._depth -= 1
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def stop(self, timeout: float = 10.0):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def depth(self) -> int:
+        return self._depth
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.concurrency,
+            "depth": self._depth,
+            "active": self._active,
+            "chats": len(self._locks),
+            "processed": self._processed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+            "max_pending": self.max_pending,
+        }
@@ -0,0 +1,203 @@
+import re
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Hashable, List
+
+from utiles.circuit_breaker import is_failure
+from utiles.logger import Logger
+
+logger = Logger(__name__)
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub("", text.casefold())).strip()
+
+
+class _Pending:
+    def __init__(self, writer: Callable[[List[str]], None]):
+        self.writer = writer
+        self.items: List[str] = []
+        self.last_role = None
+        self.last_norm = ""
+        self.first_at = 0.0
+        self.retry_at = 0.0
+        self.recent = deque()
+        self.recent_set = set()
+
+
+class WriteBehindBuffer:
+    """Collects text per key and hands it to the key's writer in batches.
+
+    A key is flushed once it holds ``max_items`` entries or its oldest entry
+    is ``max_age`` seconds old. Exact repeats (after normalising case,
+    punctuation and whitespace) of any of the last ``dedup_window`` entries
+    from the same role are dropped, and a message that only extends the
+    previous one from the same role replaces it.
+
+    A batch the writer fails on is put back and retried after ``max_age``,
+    at most ``max_items`` entries at a time however much piles up. One the
+    service refuses (a 4xx other than 429) is dropped.
+    """
+
+    def __init__(self, max_items: int = 20, max_age: float = 5.0, dedup_window: int = 50, name: str = "write-behind"):
+        self.max_items = max_items
+        self.max_age = max_age
+        self.dedup_window = dedup_window
+        self.name = name
+        self._pending: Dict[Hashable, _Pending] = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.refused = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def add(self, key: Hashable, role: str, text: str, writer: Callable[[List[str]], None]):
+        self.start()
+        norm = normalize(text)
+        with self._cond:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _Pending(writer)
+            dedup_key = f"{role}:{norm}" if norm else None
+            if dedup_key and dedup_key in pending.recent_set:
+                self.dropped += 1
+                return
+
+            line = f"[{role}]: {text}"
+            if pending.items and pending.last_role == role and pending.last_norm \
+                    and norm.startswith(pending.last_norm + " "):
+                pending.items[-1] = line
+                self.dropped += 1
+            else:
+                pending.items.append(line)
+            if not pending.first_at:
+                pending.first_at = time.monotonic()
+            pending.last_role = role
+            pending.last_norm = norm
+
+            if dedup_key:
+                pending.recent.append(dedup_key)
+                pending.recent_set.add(dedup_key)
+                if len(pending.recent) > self.dedup_window:
+                    pending.recent_set.discard(pending.recent.popleft())
+
+            if len(pending.items) >= self.max_items:
+                self._cond.notify()
+
+    def _take_due(self, force: bool = False):
+        now = time.monotonic()
+        due = []
+        for key, pending in self._pending.items():
+            if not pending.items or (not force and now < pending.retry_at):
+                continue
+            if force or len(pending.items) >= self.max_items or now - pending.first_at >= self.max_age:
+                due.extend(self._take(key, pending, everything=force))
+        return due
+
+    def _take(self, key: Hashable, pending: _Pending, everything: bool = False):
+        # a batch may be written as one passage, so lines piled up during an outage go out max_items at a time
+        batches = []
+        while pending.items:
+            batches.append((key, pending.writer, pending.items[:self.max_items]))
+            pending.items = pending.items[self.max_items:]
+            if not everything:
+                break
+        if not pending.items:
+            pending.first_at = 0.0
+            pending.last_norm = ""
+        return batches
+
+    def _write(self, due):
+        failed: Dict[Hashable, tuple] = {}
+        for key, writer, items in due:
+            if key in failed:
+                # behind the batch that just failed, so the key's order is kept
+                failed[key][1].extend(items)
+                continue
+            try:
+                writer(items)
+                self.written += len(items)
+            except Exception as e:
+                if not is_failure(e):
+                    self.refused += len(items)
+                    logger.error(f"Dropping {len(items)} buffered items for {key}, they were refused: {e}")
+                    continue
+                self.failed += len(items)
+                logger.error(f"Failed to write {len(items)} buffered items for {key}: {e}")
+                failed[key] = (writer, list(items))
+        if not failed:
+            return
+        with self._cond:
+            for key, (writer, items) in failed.items():
+                pending = self._pending.get(key)
+                if pending is None and self._running:
+                    # discarded while this batch was out
+                    pending = self._pending[key] = _Pending(writer)
+                if pending is not None and self._running:
+                    # put them back in front so they go out before anything added since
+                    pending.items = items + pending.items
+                    pending.first_at = pending.first_at or time.monotonic()
+                    pending.retry_at = time.monotonic() + self.max_age
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                due = self._take_due()
+                if not due:
+                    self._cond.wait(timeout=min(self.max_age, 1.0))
+                    continue
+            self._write(due)
+
+    def flush(self, key: Hashable = None):
+        with self._cond:
+            if key is None:
+                due = self._take_due(force=True)
+            else:
+                pending = self._pending.get(key)
+                due = self._take(key, pending, everything=True) if pending else []
+        self._write(due)
+
+    def discard(self, key: Hashable):
+        """Forget ``key``'s dedup state, unless it still has items waiting to be written."""
+        with self._cond:
+            pending = self._pending.get(key)
+            if pending is not None and not pending.items:
+                del self._pending[key]
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+        self.flush()
+
+    def depth(self) -> int:
+        with self._cond:
+            return sum(len(pending.items) for pending in self._pending.values())
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.depth(),
+            "keys": len(self._pending),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "refused": self.refused,
+        }